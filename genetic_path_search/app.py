@@ -8,6 +8,7 @@ import sys
 import logging
 
 import user_action
+import instrument
 
 from colors import *
 from path_model import *
@@ -34,50 +35,82 @@ class FieldSprite(CommonSprite):
         super(FieldSprite, self).__init__((0, 0), config['window']['size'])
         self._config = config
         self._show_best = False
+        self._max_paths = config['field'].get('max_drawn_paths')
+        self._background = None
+        self._generation = None
+        self._dirty = True
 
     def toggle_show_best(self):
         self._show_best = not self._show_best
+        self._dirty = True
 
-    def redraw(self, model):
-        """(FieldSprite, PathModel) -> NoneType
+    def _draw_background(self, model):
+        """Start, destination and penalty areas never change, they are
+        drawn once.
         """
-        self.image.fill(to_color(self._config['field']['color']))
+        self._background = pygame.Surface(self.size)
+        self._background.fill(to_color(self._config['field']['color']))
         pygame.draw.circle(
-            self.image,
+            self._background,
             to_color(self._config['field']['start_color']),
             model.start,
             self._config['field']['point_size'])
 
         pygame.draw.circle(
-            self.image,
+            self._background,
             to_color(self._config['field']['destination_color']),
             model.destination,
             self._config['field']['point_size'])
 
         for area in model.penalty_areas:
             pygame.draw.circle(
-                self.image,
+                self._background,
                 to_color(self._config['field']['penalty_area_color']),
                 *area)
 
-        for line in model.population:
+    def _shown_paths(self, model):
+        """Paths to draw: the best one only, all of them or, over
+        max_drawn_paths, that many evenly spaced by rank from the best.
+        """
+        population = model.population
+        if self._show_best:
+            return population[:1]
+        if self._max_paths is None or len(population) <= self._max_paths:
+            return population
+        ranks = numpy.linspace(0, len(population) - 1, self._max_paths)
+        return [population[rank] for rank in numpy.unique(ranks.astype(int))]
+
+    def redraw(self, model):
+        """(FieldSprite, PathModel) -> bool
+
+        Draw the field unless it already shows this generation. Returns
+        whether anything was drawn.
+        """
+        if not self._dirty and model.generation == self._generation:
+            return False
+        self._dirty = False
+        self._generation = model.generation
+
+        if self._background is None:
+            self._draw_background(model)
+        self.image.blit(self._background, (0, 0))
+
+        paths = self._shown_paths(model)
+        for line in paths:
             pygame.draw.lines(
                 self.image,
                 to_color(self._config['field']['path_color']),
                 False,
                 line)
-            if self._show_best:
-                break
 
-        for line in model.population:
+        for line in paths:
             for ppoint in line.penalty_points:
                 pygame.draw.circle(
                     self.image,
                     to_color(self._config['field']['penalty_point_color']),
                     ppoint,
                     self._config['field']['penalty_point_size'])
-            if self._show_best:
-                break
+        return True
 
 def init_window(config):
     pygame.init()
@@ -120,12 +153,20 @@ def loop(window, config):
     model = PathModel(config)
     pygame.event.wait()
     while True:
-        field.redraw(model)
-        field.draw(window)
-        pygame.display.flip()
+        profiling = profiler.enabled
+        if profiling:
+            clock = profiler.clock()
+        if field.redraw(model):
+            field.draw(window)
+            pygame.display.flip()
+        if profiling:
+            clock = profiler.add_time('frame.render', clock)
+            profiler.count('frames')
         action = handle_input(pygame.event.poll())
         if action == user_action.RUN_EVOLUTION:
             model.evolution()
+            if profiling:
+                profiler.add_time('frame.evolution', clock)
         elif action == user_action.QUIT:
             break
         elif action == user_action.TOGGLE_SHOW_BEST:
@@ -139,15 +180,20 @@ def parse_args():
         default=os.path.join(os.path.dirname(__file__), 'config.yaml'),
         type=argparse.FileType('rt'),
         help='path to config')
+    instrument.add_arguments(parser)
 
     args = parser.parse_args()
-    args.config = yaml.load(args.config)
+    args.config = yaml.safe_load(args.config)
     Colors().set_colordict(args.config['colors'])
     return args
 
 def main(args):
+    instrument.start(args)
     window = init_window(args.config)
-    loop(window, args.config)
+    try:
+        loop(window, args.config)
+    finally:
+        instrument.finish(args)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""Headless runner for the genetic path search.
+
+Runs PathModel without any display and streams per-generation
+statistics as CSV or JSON lines:
+
+    $ python batch.py -n 500 -o log.csv
+    $ python batch.py --patience 50 --format jsonl --population-size 200
+
+With --checkpoint the state is saved every --checkpoint-every seconds
+and at the end; --resume continues from it and appends to the log, -n
+counts generations of the whole run then:
+
+    $ python batch.py -n 100000 -o log.csv --checkpoint run.npz --resume
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import yaml
+import argparse
+import logging
+
+import numpy
+
+from path_model import *
+
+import instrument
+import checkpoint
+
+
+def cache_counts(model):
+    """(PathModel) -> (int, int)
+
+    Hits and misses of the model's fitness cache so far.
+    """
+    if model.fitness_cache is None:
+        return 0, 0
+    return model.fitness_cache.hits, model.fitness_cache.misses
+
+
+def generation_stats(model, seconds, counts=(0, 0)):
+    """(PathModel, float, (int, int)) -> dict
+
+    counts are cache hits and misses before the generation, the stats
+    tell how many of them the generation added.
+    """
+    if model.store is not None:
+        # Read the arrays, views of the rows would be made for nothing.
+        store = model.store
+        costs = store.costs
+        best_cost = float(costs[0])
+        penalty_count = int(store.penalties[0])
+        path_points = int(store.sizes[0])
+    else:
+        best = model.population[0]
+        costs = [i.cost for i in model.population]
+        best_cost = best.cost
+        penalty_count = len(best.penalty_points)
+        path_points = len(best)
+    stats = {
+        'generation': model.generation,
+        'best_cost': best_cost,
+        'median_cost': float(numpy.median(costs)),
+        'penalty_count': penalty_count,
+        'path_points': path_points,
+        'time': seconds,
+    }
+    if model.fitness_cache is not None:
+        hits, misses = cache_counts(model)
+        stats['cache_hits'] = hits - counts[0]
+        stats['cache_misses'] = misses - counts[1]
+    return stats
+
+
+def run(model, generations=None, patience=None, min_delta=0.):
+    """(PathModel, int, int, float) -> iterator of dict
+
+    Run evolution and yield statistics of every generation. Stop after
+    the given number of generations or when the best cost hasn't
+    improved by more than min_delta for patience generations.
+    """
+    if generations is None and patience is None:
+        raise ValueError('at least one stop condition is required')
+
+    best_cost = model.best_costs(1)[0]
+    stale = 0
+    done = 0
+    while generations is None or done < generations:
+        counts = cache_counts(model)
+        start = time.time()
+        model.evolution()
+        stats = generation_stats(model, time.time() - start, counts)
+        done += 1
+        yield stats
+
+        if stats['best_cost'] < best_cost - min_delta:
+            best_cost = stats['best_cost']
+            stale = 0
+        else:
+            stale += 1
+        if patience is not None and stale >= patience:
+            break
+
+
+class StatsLog(object):
+    """StatsLog -- writes generation statistics as CSV or JSON lines.
+    """
+    def __init__(self, stream, fmt='csv', header=True):
+        if fmt not in ('csv', 'jsonl'):
+            raise ValueError('Unknown log format: {0}'.format(fmt))
+        self._stream = stream
+        self._fmt = fmt
+        self._header = header
+        self._writer = None
+
+    def write(self, stats):
+        """(StatsLog, dict) -> NoneType
+        """
+        if self._fmt == 'jsonl':
+            self._stream.write(json.dumps(stats) + '\n')
+        else:
+            if self._writer is None:
+                self._writer = csv.DictWriter(
+                    self._stream, list(stats), lineterminator='\n')
+                if self._header:
+                    self._writer.writeheader()
+            self._writer.writerow(stats)
+        self._stream.flush()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '-c', '--config',
+        default=os.path.join(os.path.dirname(__file__), 'config.yaml'),
+        type=argparse.FileType('rt'),
+        help='path to config')
+    parser.add_argument(
+        '-n', '--generations', type=int,
+        help='number of generations to run')
+    parser.add_argument(
+        '--patience', type=int,
+        help='stop after this many generations without improvement')
+    parser.add_argument(
+        '--min-delta', type=float, default=0.,
+        help='smallest decrease of the best cost counted as improvement')
+    parser.add_argument(
+        '--population-size', type=int,
+        help='override model.population_size')
+    parser.add_argument(
+        '--mutation-probability', type=float,
+        help='override model.mutation_probability')
+    parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument(
+        '-o', '--output', default='-',
+        help='where to write the log (stdout by default)')
+    parser.add_argument(
+        '--format', choices=('csv', 'jsonl'),
+        help='log format, guessed from the output name by default')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='log every generation of the model')
+    parser.add_argument(
+        '--checkpoint',
+        help='path of the .npz checkpoint to save the state to')
+    parser.add_argument(
+        '--checkpoint-every', type=float, default=60.,
+        help='seconds between checkpoints')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='continue from the checkpoint if it exists')
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+    if args.generations is None and args.patience is None:
+        parser.error('one of --generations or --patience is required')
+    if args.resume and args.checkpoint is None:
+        parser.error('--resume needs --checkpoint')
+    if args.format is None:
+        args.format = 'jsonl' if args.output.endswith(
+            ('.jsonl', '.json')) else 'csv'
+
+    args.config = yaml.safe_load(args.config)
+    if args.population_size is not None:
+        args.config['model']['population_size'] = args.population_size
+    if args.mutation_probability is not None:
+        args.config['model']['mutation_probability'] = \
+            args.mutation_probability
+    return args
+
+
+def main(args):
+    instrument.start(args)
+    if args.seed is not None:
+        args.config['model']['seed'] = args.seed
+    model = PathModel(args.config)
+
+    generations = args.generations
+    resumed = args.resume and os.path.exists(args.checkpoint)
+    if resumed:
+        model.load_state(checkpoint.load(args.checkpoint))
+        logging.info('Resumed from generation %d', model.generation)
+        if generations is not None:
+            generations = max(0, generations - model.generation + 1)
+
+    if args.output == '-':
+        stream, header = sys.stdout, not resumed
+    else:
+        stream = open(args.output, 'at' if resumed else 'wt')
+        header = stream.tell() == 0
+    log = StatsLog(stream, args.format, header)
+
+    checkpointer = None
+    if args.checkpoint is not None:
+        checkpointer = checkpoint.Checkpointer(
+            args.checkpoint, model.state, args.checkpoint_every)
+    try:
+        for stats in run(model, generations, args.patience,
+                         args.min_delta):
+            log.write(stats)
+            if checkpointer is not None:
+                checkpointer.maybe_save()
+    finally:
+        if checkpointer is not None:
+            checkpointer.close()
+        model.close()
+        if stream is not sys.stdout:
+            stream.close()
+        instrument.finish(args)
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING)
+    main(args)
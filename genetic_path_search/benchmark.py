@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""Benchmark of the genetic path search on synthetic obstacle maps.
+
+Every map has the given number of random penalty areas covering about
+the same share of the window. Cost of evaluation and of one generation
+and time to reach --target times the straight line distance are written
+as JSON, so runs on different commits can be compared. A summary of
+every map goes to stderr:
+
+    $ python benchmark.py -o before.json
+    $ python benchmark.py --areas 10 100 --penalty segments -o after.json
+"""
+
+import os
+import sys
+import math
+import time
+import json
+import yaml
+import argparse
+import platform
+import subprocess
+import logging
+
+import numpy
+
+from path_model import *
+
+
+def obstacle_map(count, size, rng, coverage=0.15):
+    """(int, (float, float), RandomState, float) -> [((x, y), R)]
+
+    count areas of equal radius, together about coverage of the window
+    if they didn't overlap.
+    """
+    width, height = size
+    radius = math.sqrt(coverage * width * height / (math.pi * count))
+    centers = rng.uniform(0, 1, (count, 2)) * numpy.array(size, dtype=float)
+    return [(center.tolist(), radius) for center in centers]
+
+
+def environment():
+    """() -> dict
+
+    What the results depend on besides the code: versions and commit.
+    """
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def measure(config, count, seed, generations, time_limit, target):
+    """(dict, int, int, int, float, float) -> dict
+
+    Benchmark one map. Generations are timed on a fresh model, time to
+    target on another one, both seeded the same way.
+    """
+    areas = obstacle_map(count, config['window']['size'],
+                         numpy.random.RandomState(seed))
+    config = dict(config, model=dict(config['model'], penalty_areas=areas,
+                                     seed=seed))
+    start = numpy.array(config['model']['start'], dtype=float)
+    destination = numpy.array(config['model']['destination'], dtype=float)
+    target_cost = target * math.hypot(*(destination - start))
+
+    model = PathModel(config)
+    try:
+        begin = time.time()
+        index = PenaltyIndex(*model._index_args)
+        index_time = time.time() - begin
+
+        paths = [Individual(numpy.array(i)) for i in model.population]
+        for path in paths:
+            path.set_penalty_areas(index)
+        begin = time.time()
+        evaluate_population(paths, index)
+        evaluate_time = (time.time() - begin) / len(paths)
+
+        begin = time.time()
+        for path in paths:
+            path._calc_cost()
+        calc_cost_time = (time.time() - begin) / len(paths)
+
+        begin = time.time()
+        for _ in range(generations):
+            model.evolution()
+        generation_time = (time.time() - begin) / generations
+    finally:
+        model.close()
+
+    model = PathModel(config)
+    initial_cost = model.best_costs(1)[0]
+    target_generation = target_time = None
+    try:
+        begin = time.time()
+        while time.time() - begin < time_limit:
+            model.evolution()
+            if model.best_costs(1)[0] <= target_cost:
+                target_generation = model.generation
+                target_time = time.time() - begin
+                break
+    finally:
+        model.close()
+
+    return {
+        'areas': count,
+        'seed': seed,
+        'index_time': index_time,
+        'evaluate_time': evaluate_time,
+        'calc_cost_time': calc_cost_time,
+        'generation_time': generation_time,
+        'initial_cost': initial_cost,
+        'best_cost': model.best_costs(1)[0],
+        'generations': model.generation,
+        'target_cost': target_cost,
+        'target_time': target_time,
+        'target_generation': target_generation,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '-c', '--config',
+        default=os.path.join(os.path.dirname(__file__), 'config.yaml'),
+        type=argparse.FileType('rt'),
+        help='path to config')
+    parser.add_argument(
+        '--areas', type=int, nargs='+', default=[10, 100, 1000],
+        help='numbers of penalty areas of the maps')
+    parser.add_argument(
+        '--generations', type=int, default=20,
+        help='generations timed per map')
+    parser.add_argument(
+        '-t', '--time-limit', type=float, default=10.,
+        help='wall clock budget to reach the target per map in seconds')
+    parser.add_argument(
+        '--target', type=float, default=2.,
+        help='target cost relative to the straight line distance')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='random seed of the maps and the runs')
+    parser.add_argument(
+        '--population-size', type=int,
+        help='override model.population_size')
+    parser.add_argument(
+        '--penalty', choices=('samples', 'segments'),
+        help='override model.penalty')
+    parser.add_argument(
+        '--representation', choices=('individuals', 'arrays'),
+        help='override model.representation')
+    parser.add_argument(
+        '-o', '--output', default='-',
+        type=argparse.FileType('wt'),
+        help='where to write results (stdout by default)')
+
+    args = parser.parse_args()
+    args.config = yaml.safe_load(args.config)
+    for name in ('population_size', 'penalty', 'representation'):
+        if getattr(args, name) is not None:
+            args.config['model'][name] = getattr(args, name)
+    return args
+
+
+def main(args):
+    results = []
+    for count in args.areas:
+        result = measure(args.config, count, args.seed, args.generations,
+                         args.time_limit, args.target)
+        results.append(result)
+        print('{0:>6} areas: {1:8.2f} ms per generation, best cost {2:.1f} '
+              'after {3} generations, target {4}'.format(
+                  count, 1000 * result['generation_time'],
+                  result['best_cost'], result['generations'],
+                  'not reached' if result['target_time'] is None else
+                  'reached in {0:.2f} s'.format(result['target_time'])),
+              file=sys.stderr)
+
+    model = dict(args.config['model'])
+    del model['penalty_areas']
+    json.dump({
+        'benchmark': 'genetic_path_search',
+        'environment': environment(),
+        'config': model,
+        'results': results,
+    }, args.output, indent=2)
+    args.output.write('\n')
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main(parse_args())
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Checkpoints of model state in .npz files.
+
+A state is a dict, possibly nested, of numpy arrays and plain values
+like the one returned by the models' state(). Arrays are stored as they
+are under their '/' joined key, everything else goes to one JSON entry:
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'run.npz')
+    >>> save(path, {'order': numpy.arange(3), 'random': {'state': 2**70}})
+    >>> state = load(path)
+    >>> state['order'], state['random']['state'] == 2**70
+    (array([0, 1, 2]), True)
+
+Checkpointer writes them periodically from a background thread.
+"""
+
+import os
+import json
+import time
+import threading
+
+import numpy
+
+
+def _flatten(state, prefix=''):
+    arrays, values = {}, {}
+    for key, value in state.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            nested_arrays, nested_values = _flatten(value, name + '/')
+            arrays.update(nested_arrays)
+            values.update(nested_values)
+        elif isinstance(value, numpy.ndarray):
+            arrays[name] = value
+        elif isinstance(value, numpy.generic):
+            values[name] = value.item()
+        else:
+            values[name] = value
+    return arrays, values
+
+
+def _nest(flat):
+    state = {}
+    for name, value in flat.items():
+        keys = name.split('/')
+        place = state
+        for key in keys[:-1]:
+            place = place.setdefault(key, {})
+        place[keys[-1]] = value
+    return state
+
+
+def save(path, state):
+    """(str, dict) -> NoneType
+
+    Write the state atomically: a crash while writing leaves the
+    previous checkpoint intact.
+    """
+    arrays, values = _flatten(state)
+    arrays['__values__'] = numpy.array(json.dumps(values))
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as stream:
+        numpy.savez(stream, **arrays)
+    os.replace(temporary, path)
+
+
+def load(path):
+    """(str) -> dict
+    """
+    with numpy.load(path) as data:
+        flat = {name: data[name] for name in data.files
+                if name != '__values__'}
+        flat.update(json.loads(str(data['__values__'])))
+    return _nest(flat)
+
+
+class Checkpointer(object):
+    """Checkpointer -- saves states every so many seconds in the
+    background.
+
+    state is called in the caller's thread and must return a copy the
+    model won't change; only writing happens on the thread. When the
+    writer falls behind, older pending states are dropped.
+    """
+    def __init__(self, path, state, every=60.):
+        self.path = path
+        self.every = every
+        self.saved = 0
+        self._state = state
+        self._last = time.time()
+        self._pending = None
+        self._ready = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def maybe_save(self):
+        """(Checkpointer) -> NoneType
+
+        Hand the current state to the writer if it is time to.
+        """
+        if time.time() - self._last >= self.every:
+            self.save()
+
+    def save(self):
+        """(Checkpointer) -> NoneType
+        """
+        self._last = time.time()
+        state = self._state()
+        with self._ready:
+            self._pending = state
+            self._ready.notify()
+
+    def _write(self):
+        while True:
+            with self._ready:
+                while self._pending is None and not self._closed:
+                    self._ready.wait()
+                state, self._pending = self._pending, None
+                if state is None:
+                    return
+            save(self.path, state)
+            self.saved += 1
+
+    def close(self, final=True):
+        """(Checkpointer, bool) -> NoneType
+
+        Save the final state unless told otherwise and wait until
+        everything is written.
+        """
+        if final:
+            self.save()
+        with self._ready:
+            self._closed = True
+            self._ready.notify()
+        self._thread.join()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Bounded cache of path costs.
+
+Elitism, mutated copies of the best path and mutations which change
+nothing make many paths of a generation identical to ones evaluated
+before. The cache maps the content of a path together with the penalty
+areas it was evaluated against to whatever the evaluation produced and
+forgets the least recently used entries first.
+"""
+
+import hashlib
+import collections
+
+import numpy
+
+
+class FitnessCache(object):
+    """FitnessCache -- LRU map from path content to its evaluation.
+    """
+    KEY_SIZE = 16
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    @staticmethod
+    def key(points, penalty_index, delta):
+        """((K, 2) numpy.array, PenaltyIndex, float) -> bytes
+        """
+        digest = hashlib.blake2b(digest_size=FitnessCache.KEY_SIZE)
+        digest.update(penalty_index.digest)
+        digest.update(numpy.float64(delta).tobytes())
+        digest.update(numpy.ascontiguousarray(points, dtype=float).tobytes())
+        return digest.digest()
+
+    def get(self, key):
+        """(FitnessCache, bytes) -> object
+
+        Cached value or None, counts hits and misses.
+        """
+        value = self._items.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._items.move_to_end(key)
+        return value
+
+    def items(self):
+        """(FitnessCache) -> [(bytes, object)]
+
+        Entries from the least to the most recently used.
+        """
+        return list(self._items.items())
+
+    def put(self, key, value):
+        """(FitnessCache, bytes, object) -> NoneType
+        """
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
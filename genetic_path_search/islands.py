@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""Island model of the genetic path search.
+
+Several populations evolve independently, each in its own worker
+process with its own seed. Every --migration-interval generations the
+best --migrants paths of every island replace the worst ones of another
+island: the next one on a ring or a random one. The coordinator logs
+per-generation statistics of all islands as CSV or JSON lines:
+
+    $ python islands.py --islands 8 -n 500 -o log.csv
+    $ python islands.py --islands 4 -n 200 --topology random --seed 1
+
+Islands only exchange paths at migrations, so the result depends on the
+seed and not on whether islands run in processes or in turn here
+(--no-processes).
+"""
+
+import os
+import sys
+import time
+import yaml
+import argparse
+import logging
+import traceback
+import multiprocessing
+
+import numpy
+
+from path_model import *
+from batch import run, StatsLog
+
+import instrument
+
+
+TOPOLOGIES = ('ring', 'random')
+
+
+def _evolve(model, generations, immigrants, migrants):
+    model.immigrate(immigrants)
+    stats = list(run(model, generations))
+    return stats, model.best_paths(migrants)
+
+
+def _island(connection, config):
+    """Worker process: one model evolving on request.
+
+    Every message is (generations, immigrants, migrants) and is answered
+    with ('ok', (stats of every generation, emigrants)), None stops it.
+    """
+    model = PathModel(config)
+    try:
+        while True:
+            message = connection.recv()
+            if message is None:
+                break
+            try:
+                connection.send(('ok', _evolve(model, *message)))
+            except Exception:
+                connection.send(('error', traceback.format_exc()))
+    finally:
+        model.close()
+        connection.close()
+
+
+class Islands(object):
+    """Islands -- populations evolving apart and exchanging their best.
+    """
+    def __init__(self, config, islands=4, migration_interval=10,
+                 migrants=None, topology='ring', processes=True, seed=None):
+        if topology not in TOPOLOGIES:
+            raise ValueError('Unknown topology: {0}'.format(topology))
+        if islands < 1:
+            raise ValueError('At least one island is required')
+        self.islands = islands
+        self.migration_interval = migration_interval
+        self.migrants = (config['model']['num_to_choose'] if migrants is None
+                         else migrants)
+        self.topology = topology
+        self.migrations = 0
+
+        seeds = numpy.random.SeedSequence(seed).spawn(islands + 1)
+        self.random = numpy.random.default_rng(seeds[0])
+        # Islands run in parallel already, their models don't fork more.
+        configs = [dict(config, model=dict(
+            config['model'], workers=1,
+            seed=int(island_seed.generate_state(1)[0])))
+            for island_seed in seeds[1:]]
+
+        self._models = None
+        self._workers = []
+        if processes:
+            for island_config in configs:
+                ours, theirs = multiprocessing.Pipe()
+                worker = multiprocessing.Process(
+                    target=_island, args=(theirs, island_config),
+                    daemon=True)
+                worker.start()
+                theirs.close()
+                self._workers.append((worker, ours))
+        else:
+            self._models = [PathModel(c) for c in configs]
+        self._immigrants = [[] for _ in range(islands)]
+        self.best_paths = [None] * islands
+
+    def _destinations(self):
+        if self.topology == 'ring' or self.islands == 1:
+            return [(i + 1) % self.islands for i in range(self.islands)]
+        # Any island but the source itself.
+        targets = self.random.integers(self.islands - 1, size=self.islands)
+        return [t + (t >= i) for i, t in enumerate(targets.tolist())]
+
+    def evolve(self, generations):
+        """(Islands, int) -> [[dict]]
+
+        Run every island for the given number of generations after
+        letting in the paths migrated to it. Returns statistics of every
+        generation of every island; the best paths of the islands are
+        kept as emigrants for the next call.
+        """
+        if any(self._immigrants):
+            self.migrations += 1
+        messages = [(generations, immigrants, self.migrants)
+                    for immigrants in self._immigrants]
+        if self._models is not None:
+            results = [_evolve(model, *message)
+                       for model, message in zip(self._models, messages)]
+        else:
+            for (worker, connection), message in zip(self._workers,
+                                                     messages):
+                connection.send(message)
+            results = []
+            for worker, connection in self._workers:
+                status, result = connection.recv()
+                if status != 'ok':
+                    raise RuntimeError('Island failed:\n' + result)
+                results.append(result)
+
+        stats = [island_stats for island_stats, _ in results]
+        self.best_paths = [emigrants for _, emigrants in results]
+        self._immigrants = [[] for _ in range(self.islands)]
+        if self.islands > 1:
+            for source, target in enumerate(self._destinations()):
+                self._immigrants[target].extend(self.best_paths[source])
+        return stats
+
+    def close(self):
+        """(Islands) -> NoneType
+
+        Stop worker processes if any.
+        """
+        for worker, connection in self._workers:
+            connection.send(None)
+            connection.close()
+            worker.join()
+        self._workers = []
+        if self._models is not None:
+            for model in self._models:
+                model.close()
+
+
+def aggregate(generation_stats):
+    """([dict]) -> dict
+
+    One row of statistics for a generation of all islands: the best
+    and the median of island best costs and the best cost of every
+    island.
+    """
+    best_costs = [stats['best_cost'] for stats in generation_stats]
+    best = int(numpy.argmin(best_costs))
+    row = {
+        'generation': generation_stats[0]['generation'],
+        'best_cost': best_costs[best],
+        'median_best_cost': float(numpy.median(best_costs)),
+        'best_island': best,
+        'time': max(stats['time'] for stats in generation_stats),
+    }
+    for island, cost in enumerate(best_costs):
+        row['best_cost_{0}'.format(island)] = cost
+    return row
+
+
+def run_islands(islands, generations):
+    """(Islands, int) -> iterator of dict
+
+    Evolve the islands for the given number of generations with
+    migrations between every migration_interval of them and yield
+    aggregated statistics of every generation.
+    """
+    done = 0
+    while done < generations:
+        steps = min(islands.migration_interval, generations - done)
+        start = time.time()
+        stats = islands.evolve(steps)
+        spent = time.time() - start
+        for generation in range(steps):
+            row = aggregate([island[generation] for island in stats])
+            row['epoch_time'] = spent
+            yield row
+        done += steps
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '-c', '--config',
+        default=os.path.join(os.path.dirname(__file__), 'config.yaml'),
+        type=argparse.FileType('rt'),
+        help='path to config')
+    parser.add_argument(
+        '-n', '--generations', type=int, required=True,
+        help='number of generations of every island')
+    parser.add_argument('--islands', type=int, help='number of islands')
+    parser.add_argument(
+        '--migration-interval', type=int,
+        help='generations between migrations')
+    parser.add_argument(
+        '--migrants', type=int,
+        help='best paths every island sends (num_to_choose by default)')
+    parser.add_argument(
+        '--topology', choices=TOPOLOGIES,
+        help='where migrants go: the next island or a random one')
+    parser.add_argument(
+        '--no-processes', dest='processes', action='store_false',
+        default=None,
+        help='run the islands in turn in this process')
+    parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument(
+        '-o', '--output', default='-',
+        help='where to write the log (stdout by default)')
+    parser.add_argument(
+        '--format', choices=('csv', 'jsonl'),
+        help='log format, guessed from the output name by default')
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+    if args.format is None:
+        args.format = 'jsonl' if args.output.endswith(
+            ('.jsonl', '.json')) else 'csv'
+    args.config = yaml.safe_load(args.config)
+    return args
+
+
+def main(args):
+    instrument.start(args)
+    options = dict(args.config.get('islands', {}))
+    for name in ('islands', 'migration_interval', 'migrants', 'topology',
+                 'processes', 'seed'):
+        if getattr(args, name) is not None:
+            options[name] = getattr(args, name)
+    if options.get('seed') is None:
+        options['seed'] = args.config['model'].get('seed')
+
+    stream = sys.stdout if args.output == '-' else open(args.output, 'wt')
+    log = StatsLog(stream, args.format)
+    islands = Islands(args.config, **options)
+    start = time.time()
+    try:
+        for stats in run_islands(islands, args.generations):
+            log.write(stats)
+    finally:
+        islands.close()
+        if stream is not sys.stdout:
+            stream.close()
+        instrument.finish(args)
+    elapsed = time.time() - start
+    print('{0} islands, {1} generations in {2:.1f} s: {3:.1f} generations/s, '
+          '{4} migrations'.format(
+              islands.islands, args.generations, elapsed,
+              islands.islands * args.generations / elapsed,
+              islands.migrations),
+          file=sys.stderr)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main(parse_args())
@@ -4,26 +4,92 @@ import numpy
 import numpy.random as random
 import math
 import logging
-import copy
-
-
-def distance_to_section_from_circle(point1, point2, area):
-    center, R = area
-    center = numpy.array(center)
-
-    ao = center - point1
-    bo = center - point2
-    ab = point2 - point1
-
-    k = sum(ao * ab) / math.hypot(*ab)**2
-    EPS = 0.00001
-    if abs(k) > EPS and abs(k - 1) < EPS:
-        ac = k * math.hypot(*ab)
-        r = math.sqrt(math.hypot(*ao)**2 - ac**2)
-    else:
-        r = min(math.hypot(*ao), math.hypot(*bo))
-
-    return max(0, R - r)
+import concurrent.futures
+
+from penalty_index import PenaltyIndex
+from fitness_cache import FitnessCache
+from instrument import profiler
+from population import Population, evaluate_paths
+
+
+# Everything evaluate_population() tells about an individual.
+FITNESS_FIELDS = ('_cost', '_length', '_penalty_points', '_segment_lengths',
+                  '_segment_inside')
+
+
+def evaluate_population(individuals, penalty_index, delta=10., cache=None,
+                        evaluate=None):
+    """([Individual], PenaltyIndex, float, FitnessCache, callable)
+        -> NoneType
+
+    Calculate cost of all individuals at once with evaluate_paths().
+    Individuals found in the cache are not evaluated again, the rest is
+    passed to evaluate if given. Costs are exactly the same as of
+    individuals evaluated one by one:
+
+    >>> rng = numpy.random.RandomState(0)
+    >>> areas = [((300, 300), 50), ((500, 200), 150), ((140, 500), 150)]
+    >>> for penalty in ('samples', 'segments'):
+    ...     index = PenaltyIndex(areas, penalty=penalty)
+    ...     paths = [Individual(rng.rand(size, 2) * 800)
+    ...              for size in (2, 3, 7, 12)]
+    ...     for path in paths:
+    ...         path.set_penalty_areas(index)
+    ...     evaluate_population(paths, index)
+    ...     batched = [path.cost for path in paths]
+    ...     for path in paths:
+    ...         path._invalidate()
+    ...     print([path.cost for path in paths] == batched)
+    True
+    True
+    """
+    if not individuals:
+        return
+
+    if cache is not None:
+        missing = []
+        for individual in individuals:
+            key = cache.key(numpy.array(individual, dtype=float),
+                            penalty_index, delta)
+            fitness = cache.get(key)
+            if fitness is None:
+                missing.append((key, individual))
+            else:
+                for name, value in zip(FITNESS_FIELDS, fitness):
+                    setattr(individual, name, value)
+        if evaluate is None:
+            evaluate_population(
+                [i for key, i in missing], penalty_index, delta)
+        else:
+            evaluate([i for key, i in missing])
+        for key, individual in missing:
+            cache.put(key, tuple(getattr(individual, name)
+                                 for name in FITNESS_FIELDS))
+        if profiler.enabled:
+            profiler.count('cache.hits', len(individuals) - len(missing))
+            profiler.count('cache.misses', len(missing))
+        return
+
+    if profiler.enabled:
+        # Evaluations in worker processes are counted there.
+        profiler.count('evaluations', len(individuals))
+
+    sizes = numpy.array([len(i) for i in individuals])
+    points = numpy.concatenate([numpy.array(i, dtype=float).reshape(-1, 2)
+                                for i in individuals])
+    (lengths, costs, penalties, penalty_points, segments,
+     segment_inside) = evaluate_paths(points, sizes, penalty_index, delta)
+
+    ends = numpy.cumsum(sizes - 1)
+    for individual, start, end, length, cost, ppoints in zip(
+            individuals, ends - sizes + 1, ends, lengths, costs,
+            numpy.split(penalty_points, numpy.cumsum(penalties)[:-1])):
+        individual._length = float(length)
+        individual._penalty_points = list(ppoints)
+        individual._cost = float(cost)
+        if segment_inside is not None:
+            individual._segment_lengths = segments[start:end]
+            individual._segment_inside = segment_inside[start:end]
 
 
 class Individual(list):
@@ -32,7 +98,10 @@ class Individual(list):
         self._cost = None
         self._penalty_points = None
         self._length = None
-        self._penalty_areas = []
+        self._cumulative = None
+        self._segment_lengths = None
+        self._segment_inside = None
+        self._penalty_areas = PenaltyIndex([])
 
     @property
     def cost(self):
@@ -43,16 +112,40 @@ class Individual(list):
     @property
     def penalty_points(self):
         if self._penalty_points is None:
-            self.cost
+            if self._cost is not None and self._segment_inside is not None:
+                self._penalty_points = self._calc_penalty_points()
+            else:
+                self.cost
         return self._penalty_points
 
     @property
     def length(self):
         if self._length is None:
-            self._length = self._calc_length()
+            self._length = float(self.cumulative[-1])
         return self._length
 
-    def make_child(self, woman):
+    @property
+    def cumulative(self):
+        """Length of the path from start to every point.
+        """
+        if self._cumulative is None:
+            points = numpy.array(self, dtype=float)
+            segments = numpy.hypot(*numpy.diff(points, axis=0).T)
+            self._cumulative = numpy.concatenate(
+                ([0.], numpy.cumsum(segments)))
+        return self._cumulative
+
+    def _invalidate(self):
+        """Forget everything calculated from points after their change.
+        """
+        self._cost = None
+        self._penalty_points = None
+        self._length = None
+        self._cumulative = None
+        self._segment_lengths = None
+        self._segment_inside = None
+
+    def make_child(self, woman, rng):
         men = self
 
         child_len = int((len(men) + len(woman)) / 2)
@@ -61,58 +154,118 @@ class Individual(list):
         child = Individual([men[0]])
         child.set_penalty_areas(men._penalty_areas)
 
-        for point_num in range(1, child_len - 1):
-            ratio = float(point_num) / (child_len - 1)
-            first_point = men.point_by_ratio(ratio)
-            second_point = woman.point_by_ratio(ratio)
+        ratios = numpy.arange(1, child_len - 1, dtype=float) / (child_len - 1)
+        first_points = men.points_by_ratio(ratios)
+        second_points = woman.points_by_ratio(ratios)
 
-            k = min(men.cost, woman.cost) * (0.6 * random.random() - 0.3)
-            child.append(first_point * ((men.cost - k) / total_cost) +
-                         second_point * ((woman.cost + k) / total_cost))
+        k = (min(men.cost, woman.cost) *
+             (0.6 * rng.random((len(ratios), 1)) - 0.3))
+        child.extend(first_points * ((men.cost - k) / total_cost) +
+                     second_points * ((woman.cost + k) / total_cost))
         child.append(men[-1])
 
         return child
 
     def set_penalty_areas(self, areas):
+        """(Individual, PenaltyIndex) -> NoneType
+        """
         self._penalty_areas = areas
         self._cost = None  # Need to recalculate cost
+        self._penalty_points = None
 
     def __lt__(self, other):
         return self.cost < other.cost
 
-    def _calc_length(self):
-        result = 0.
-        for x in range(1, len(self)):
-            result += math.hypot(*(self[x] - self[x - 1]))
-        return result
-
     def point_by_ratio(self, ratio):
-        left = int(self.length * ratio)
-        current = 1
-        while left > 0:
-            length = math.hypot(*(self[current - 1] - self[current]))
-            if left < length:
-                coeff = float(left) / length
-                return self[current - 1] * coeff + self[current] * (1. - coeff)
-            left -= length
-            current += 1
-            if current == len(self):
-                return self[-1]
+        return self.points_by_ratio(numpy.array([ratio], dtype=float))[0]
+
+    def points_by_ratio(self, ratios):
+        """(Individual, numpy.array) -> (K, 2) numpy.array
+
+        Points which divide the path length in the given ratios, found
+        by binary search over the cumulative lengths.
+        """
+        cumulative = self.cumulative
+        distances = numpy.clip(ratios, 0., 1.) * cumulative[-1]
+        right = numpy.searchsorted(cumulative, distances, side='right')
+        right = numpy.clip(right, 1, len(self) - 1)
+        left = right - 1
+
+        points = numpy.array(self, dtype=float)
+        segments = cumulative[right] - cumulative[left]
+        coeff = numpy.clip((distances - cumulative[left]) /
+                           numpy.maximum(segments, 1e-12), 0., 1.)
+        coeff = coeff[:, numpy.newaxis]
+        return points[left] * (1. - coeff) + points[right] * coeff
 
     def _calc_cost(self, delta=10.):
-        cost = self.length
-        self._penalty_points = []
-        steps = self.length / delta
-        for x in (x / steps for x in range(1, int(steps))):
-            current = self.point_by_ratio(x)
-            for center, R in self._penalty_areas:
-                dist = math.hypot(*(current - numpy.array(center)))
-                if dist < R:
-                    self._penalty_points.append(numpy.array(current, dtype=int))
-                    break
-        return cost * math.exp(len(self.penalty_points))
-
-    def mutate(self, prob, diviation):
+        evaluate_population([self], self._penalty_areas, delta)
+        return self._cost
+
+    def _calc_penalty_points(self):
+        points = numpy.array(self, dtype=float)
+        _, _, entries, exits = self._penalty_areas.segments_inside(
+            points[:-1], points[1:])
+        return list(numpy.stack((entries, exits), axis=1)
+                    .reshape(-1, 2).astype(int))
+
+    def _measure_segments(self, first, last):
+        """(Individual, int, int) -> NoneType
+
+        Measure segments from first to last (exclusive) again in place,
+        after some of their points moved.
+        """
+        first, last = max(first, 0), min(last, len(self) - 1)
+        if first >= last:
+            return
+        points = numpy.array(self[first:last + 1], dtype=float)
+        self._segment_lengths[first:last] = numpy.hypot(
+            *numpy.diff(points, axis=0).T)
+        self._segment_inside[first:last], _, _, _ = \
+            self._penalty_areas.segments_inside(points[:-1], points[1:])
+
+    def _update_cost(self, delta=10.):
+        """(Individual, float) -> NoneType
+
+        Cost summed from per segment values after a local change.
+        """
+        lengths, inside = self._segment_lengths, self._segment_inside
+        self._invalidate()
+        self._segment_lengths, self._segment_inside = lengths, inside
+        self._length = float(lengths.sum())
+        self._cost = self._length * math.exp(inside.sum() / delta)
+
+    def mutate(self, prob, diviation, rng):
+        """(Individual, float, float, Generator) -> NoneType
+
+        Move, insert or remove a few points. When per segment costs are
+        known (the 'segments' penalty) only the segments next to changed
+        points are measured again. The 'samples' penalty samples the
+        whole path at even steps and any change shifts all samples after
+        it, so there the whole cost is dropped.
+
+        >>> index = PenaltyIndex([((300, 300), 50), ((500, 200), 150)],
+        ...                      penalty='segments')
+        >>> rng = random.default_rng(0)
+        >>> path = Individual(rng.random((12, 2)) * 800)
+        >>> path.set_penalty_areas(index)
+        >>> evaluate_population([path], index)
+        >>> for _ in range(100):
+        ...     path.mutate(0.9, 100, rng)
+        >>> path._segment_inside is not None
+        True
+        >>> fresh = Individual(numpy.array(path))
+        >>> fresh.set_penalty_areas(index)
+        >>> bool(numpy.isclose(path.cost, fresh.cost, rtol=1e-9))
+        True
+        """
+        changed = False
+        incremental = (self._cost is not None and
+                       self._segment_inside is not None)
+        # Per segment arrays may be shared with the parent, other clones
+        # and the fitness cache until they are first replaced here.
+        owned = False
+
         if (len(self) == 2):
             prob = prob / 3
         else:
@@ -120,28 +273,245 @@ class Individual(list):
 
         # Change point mutation
         if len(self) > 5:
-            while prob > random.random():
-                x = random.randint(2, len(self) - 3)
-                mutation = diviation * random.randn(2)
+            while prob > rng.random():
+                x = rng.integers(2, len(self) - 3)
+                mutation = diviation * rng.standard_normal(2)
                 self[x] += mutation * 0.5
                 self[x - 1] += mutation * 0.2
                 self[x + 1] += mutation * 0.2
+                changed = True
+                if incremental:
+                    if not owned:
+                        self._segment_lengths = self._segment_lengths.copy()
+                        self._segment_inside = self._segment_inside.copy()
+                        owned = True
+                    self._measure_segments(x - 2, x + 2)
 
         # Add point mutation
-        while prob > random.random():
-            x = random.choice(range(0, len(self) - 1))
+        while prob > rng.random():
+            x = rng.integers(len(self) - 1)
             middle = (self[x] + self[x + 1]) / 2
-            self.insert(x + 1, middle + diviation * random.randn(2))
+            self.insert(x + 1,
+                        middle + diviation * rng.standard_normal(2))
+            changed = True
+            if incremental:
+                self._segment_lengths = numpy.insert(
+                    self._segment_lengths, x, 0.)
+                self._segment_inside = numpy.insert(
+                    self._segment_inside, x, 0.)
+                owned = True
+                self._measure_segments(x, x + 2)
 
         # Remove point mutation
-        while len(self) > 2 and prob > random.random():
-            remove_index = random.choice(range(1, len(self) - 1, 1))
+        while len(self) > 2 and prob > rng.random():
+            remove_index = rng.integers(1, len(self) - 1)
             del self[remove_index]
+            changed = True
+            if incremental:
+                self._segment_lengths = numpy.delete(
+                    self._segment_lengths, remove_index)
+                self._segment_inside = numpy.delete(
+                    self._segment_inside, remove_index)
+                owned = True
+                self._measure_segments(remove_index - 1, remove_index)
+
+        if changed:
+            if incremental:
+                self._update_cost()
+            else:
+                self._invalidate()
+
+
+def breed(payload, penalty_index):
+    """(tuple, PenaltyIndex) -> tuple
+
+    Make, mutate and evaluate a chunk of children. The payload holds
+    parents as arrays of points, costs and per segment costs (or None),
+    mutation parameters, (men, woman, seed) tasks, woman is -1 for a
+    mutated copy of men, and whether to evaluate children; cost of the
+    ones left unevaluated is nan. Every child draws from its own
+    generator seeded by its task, so the result doesn't depend on the
+    process it is made in.
+    """
+    (parents_points, parents_costs, parents_segments, tasks,
+     prob, diviation, evaluate) = payload
+    parents = []
+    for points, cost in zip(parents_points, parents_costs):
+        parent = Individual(points)
+        parent.set_penalty_areas(penalty_index)
+        parent._cost = cost
+        parents.append(parent)
+
+    children = []
+    for men, woman, seed in tasks:
+        rng = random.default_rng(seed)
+        if woman < 0:
+            child = Individual(numpy.array(parents_points[men]))
+            child.set_penalty_areas(penalty_index)
+            if parents_segments[men] is not None:
+                # Known per segment costs let mutate() update the cost.
+                child._cost = parents_costs[men]
+                child._segment_lengths, child._segment_inside = \
+                    parents_segments[men]
+        else:
+            child = parents[men].make_child(parents[woman], rng)
+        child.mutate(prob, diviation, rng)
+        children.append(child)
+    if evaluate:
+        evaluate_population(
+            [c for c in children if c._cost is None], penalty_index)
+
+    segments = None
+    if any(c._segment_inside is not None for c in children):
+        # Segments of children which don't have them are nan.
+        missing = [numpy.full(len(c) - 1, numpy.nan) for c in children]
+        segments = tuple(
+            numpy.concatenate([
+                blank if c._segment_inside is None else getattr(c, name)
+                for c, blank in zip(children, missing)])
+            for name in ('_segment_lengths', '_segment_inside'))
+    known = [c._penalty_points or [] for c in children]
+    return (
+        numpy.concatenate([numpy.array(c, dtype=float) for c in children]),
+        numpy.array([len(c) for c in children]),
+        numpy.array([numpy.nan if c._cost is None else c._cost
+                     for c in children]),
+        numpy.concatenate([numpy.zeros((0, 2), dtype=int)] +
+                          [numpy.array(p, dtype=int).reshape(-1, 2)
+                           for p in known]),
+        # Penalty points of incrementally updated children are unknown
+        # until somebody asks for them.
+        numpy.array([-1 if c._penalty_points is None else len(p)
+                     for c, p in zip(children, known)]),
+        segments,
+    )
+
+
+def evaluate_packed(payload, penalty_index):
+    """((K, 2) numpy.array, (P,) numpy.array), PenaltyIndex) -> dict
+
+    Evaluate paths given by their points joined back to back and their
+    sizes, return FITNESS_FIELDS values packed by pack_fitness().
+    """
+    points, sizes = payload
+    individuals = [Individual(path) for path in
+                   numpy.split(points, numpy.cumsum(sizes)[:-1])]
+    evaluate_population(individuals, penalty_index)
+    return pack_fitness([
+        tuple(getattr(i, name) for name in FITNESS_FIELDS)
+        for i in individuals])
+
+
+def unpack_children(result, penalty_index):
+    """(tuple, PenaltyIndex) -> [Individual]
+
+    Individuals from the compact arrays returned by breed().
+    """
+    points, sizes, costs, penalty_points, penalties, segments = result
+    children = []
+    for number, (path, cost, ppoints) in enumerate(zip(
+            numpy.split(points, numpy.cumsum(sizes)[:-1]), costs,
+            numpy.split(penalty_points,
+                        numpy.cumsum(numpy.maximum(penalties, 0))[:-1]))):
+        child = Individual(path)
+        child.set_penalty_areas(penalty_index)
+        if not numpy.isnan(cost):
+            child._cost = float(cost)
+        if penalties[number] >= 0:
+            child._penalty_points = list(ppoints)
+        children.append(child)
+
+    if segments is not None:
+        offsets = numpy.cumsum(sizes - 1)[:-1]
+        for child, lengths, inside in zip(
+                children, numpy.split(segments[0], offsets),
+                numpy.split(segments[1], offsets)):
+            if numpy.isnan(inside).any():
+                continue
+            child._segment_lengths = lengths
+            child._segment_inside = inside
+    return children
+
+
+def pack_fitness(fitness):
+    """([tuple]) -> dict
+
+    Flat arrays of FITNESS_FIELDS values. Unknown values are nan,
+    unknown penalty point and segment counts are -1.
+    """
+    costs, lengths, ppoints, segment_lengths, segment_inside = \
+        zip(*fitness) if fitness else ([],) * 5
+    return {
+        'costs': numpy.array([numpy.nan if value is None else value
+                              for value in costs + lengths]).reshape(2, -1),
+        'penalty_counts': numpy.array(
+            [-1 if value is None else len(value) for value in ppoints],
+            dtype=int),
+        'penalty_points': numpy.concatenate(
+            [numpy.zeros((0, 2), dtype=int)] +
+            [numpy.array(value, dtype=int).reshape(-1, 2)
+             for value in ppoints if value is not None]),
+        'segment_counts': numpy.array(
+            [-1 if inside is None else len(inside)
+             for inside in segment_inside], dtype=int),
+        'segments': numpy.concatenate([numpy.zeros((2, 0))] + [
+            numpy.stack((lengths, inside))
+            for lengths, inside in zip(segment_lengths, segment_inside)
+            if inside is not None], axis=1),
+    }
+
+
+def unpack_fitness(arrays):
+    """(dict) -> [tuple]
+
+    FITNESS_FIELDS values packed by pack_fitness().
+    """
+    def split(values, counts, axis=0):
+        return numpy.split(values, numpy.cumsum(numpy.maximum(counts, 0))[:-1],
+                           axis=axis)
+
+    counts = arrays['penalty_counts']
+    segment_counts = arrays['segment_counts']
+    ppoints = split(arrays['penalty_points'], counts)
+    segments = split(arrays['segments'], segment_counts, axis=1)
+    fitness = []
+    for number, (cost, length) in enumerate(arrays['costs'].T):
+        known = segment_counts[number] >= 0
+        fitness.append((
+            None if numpy.isnan(cost) else float(cost),
+            None if numpy.isnan(length) else float(length),
+            None if counts[number] < 0 else list(ppoints[number]),
+            segments[number][0] if known else None,
+            segments[number][1] if known else None))
+    return fitness
+
+
+_worker_penalty_index = None
+
+
+def _init_worker(*index_args):
+    global _worker_penalty_index
+    _worker_penalty_index = PenaltyIndex(*index_args)
+
+
+def _breed_in_worker(payload):
+    return breed(payload, _worker_penalty_index)
+
+
+def _evaluate_in_worker(payload):
+    return evaluate_packed(payload, _worker_penalty_index)
+
 
 class PathModel(object):
     def __init__(self, config):
         self.start = config['model']['start']
         self.destination = config['model']['destination']
+        self.representation = config['model'].get(
+            'representation', 'individuals')
+        if self.representation not in ('individuals', 'arrays'):
+            raise ValueError(
+                'Unknown representation: {0}'.format(self.representation))
+        self.store = None
         self.population = []
         self.mutation_probability = config['model']['mutation_probability']
         self.mutate_best = config['model']['mutate_best']
@@ -152,11 +522,57 @@ class PathModel(object):
         self.maxX, self.maxY = config['window']['size']
 
         self.generation = 1
+        self.random = random.default_rng(config['model'].get('seed'))
 
         self.penalty_areas = config['model']['penalty_areas']
+        self._index_args = (
+            self.penalty_areas,
+            config['model'].get('penalty_index', 'grid'),
+            config['model'].get('penalty_cell_size'),
+            config['model'].get('penalty', 'samples'))
+        self.penalty_index = PenaltyIndex(*self._index_args)
+
+        self.workers = config['model'].get('workers', 1)
+        self.chunk_size = config['model'].get('chunk_size', 16)
+        self._executor = None
+
+        cache_size = config['model'].get('fitness_cache_size', 0)
+        self.fitness_cache = FitnessCache(cache_size) if cache_size else None
+
         self._initialize()
         self.log_generation_info()
 
+    @property
+    def population(self):
+        """Individuals sorted by cost. In the arrays representation they
+        are views of the store rows, made when somebody asks for them.
+        """
+        if self._population is None:
+            self._population = self._store_views()
+        return self._population
+
+    @population.setter
+    def population(self, population):
+        self._population = population
+
+    def _store_views(self):
+        views = []
+        for row in range(len(self.store)):
+            view = Individual(self.store.path(row))
+            view.set_penalty_areas(self.penalty_index)
+            view._cost = float(self.store.costs[row])
+            view._length = float(self.store.lengths[row])
+            view._penalty_points = list(self.store.penalty_points[row])
+            views.append(view)
+        return views
+
+    def best_costs(self, n):
+        """(PathModel, int) -> [float]
+        """
+        if self.store is not None:
+            return self.store.costs[:n].tolist()
+        return [i.cost for i in self.population[:n]]
+
     def check_point(self, point):
         if point[0] > self.maxX or point[1] > self.maxY:
             return False
@@ -173,53 +589,355 @@ class PathModel(object):
 
     def _initialize(self):
         for line_num in range(self.population_size):
-            num_points = random.randint(*self.points_in_path)
+            num_points = self.random.integers(*self.points_in_path)
             self.population.append(Individual([numpy.array(self.start)]))
             for point_num in range(num_points - 2):
-                new_point = (self.next_point_diviation * random.randn(2) +
+                new_point = (self.next_point_diviation *
+                             self.random.standard_normal(2) +
                              self.population[-1][-1])
                 new_point = self.mirror_point(new_point)
                 self.population[-1].append(new_point)
             self.population[-1].append(numpy.array(self.destination))
-            self.population[-1].set_penalty_areas(self.penalty_areas)
-        self.population.sort()
+            self.population[-1].set_penalty_areas(self.penalty_index)
+        if self.representation == 'arrays':
+            self.store = Population.from_paths(self.population)
+            self.store.evaluate(self.penalty_index, cache=self.fitness_cache)
+            self.store.sort()
+            self.population = None
+        else:
+            self.evaluate(self.population)
+            self.population.sort()
+
+    def evaluate(self, population):
+        """(PathModel, [Individual]) -> NoneType
+
+        Calculate cost of all individuals which don't know it yet. The
+        fitness cache is looked up here, the rest is evaluated by
+        evaluate_chunks().
+        """
+        individuals = [i for i in population if i._cost is None]
+        if self.fitness_cache is None:
+            self.evaluate_chunks(individuals)
+        else:
+            evaluate_population(
+                individuals, self.penalty_index, cache=self.fitness_cache,
+                evaluate=self.evaluate_chunks)
+
+    def evaluate_chunks(self, individuals):
+        """(PathModel, [Individual]) -> NoneType
+
+        Evaluate individuals in chunks of chunk_size, in worker processes
+        when there are more than one. Every path is measured on its own,
+        so the costs don't depend on chunks or workers.
+        """
+        chunks = [individuals[begin:begin + self.chunk_size]
+                  for begin in range(0, len(individuals), self.chunk_size)]
+        if self.workers <= 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                evaluate_population(chunk, self.penalty_index)
+            return
+        payloads = [
+            (numpy.concatenate([numpy.array(i, dtype=float) for i in chunk]),
+             numpy.array([len(i) for i in chunk]))
+            for chunk in chunks]
+        results = self._pool().map(_evaluate_in_worker, payloads)
+        for chunk, arrays in zip(chunks, results):
+            for individual, fitness in zip(chunk, unpack_fitness(arrays)):
+                for name, value in zip(FITNESS_FIELDS, fitness):
+                    setattr(individual, name, value)
+
+    def _pool(self):
+        """Worker processes, started on first use.
+        """
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers, initializer=_init_worker,
+                initargs=self._index_args)
+        return self._executor
 
     def log_generation_info(self):
         n = self.num_to_choose
         logging.info("="*10 + " Generation: {0} ".format(self.generation) + "="*10)
-        costs = [i.cost for i in self.population[:n]]
+        costs = self.best_costs(n)
         logging.info("Best costs: {0}".format(costs))
         p = numpy.array([1. / c for c in costs])
         p = p / sum(p)
         logging.info("Probabilities: {0}".format(p))
+        if self.fitness_cache is not None:
+            logging.info("Fitness cache hits: {0}, misses: {1}".format(
+                self.fitness_cache.hits, self.fitness_cache.misses))
 
     def evolution(self):
+        profiling = profiler.enabled
+        if profiling:
+            clock = profiler.clock()
         num_selected = self.num_to_choose
 
-        costs = [i.cost for i in self.population[:num_selected]]
-        best = self.population[:num_selected]
+        costs = self.best_costs(num_selected)
         scores = [1. / (c + 500) for c in costs]
         p = numpy.array(scores)
         p = p / sum(p)
 
-        self.population = [best[0]]
-        for i in range(self.mutate_best):
-            best_copy = copy.deepcopy(best[0])
-            self.population.append(best_copy)
-            self.population[-1].mutate(
-                self.mutation_probability,
-                self.next_point_diviation)
-
+        tasks = [(0, -1)] * self.mutate_best
         for i in range(self.population_size - 1 - self.mutate_best):
-            x = random.choice(range(num_selected), 1)[0]
-            y = random.choice(range(num_selected), 1)[0]
-            self.population.append(best[x].make_child(best[y]))
-            self.population[-1].mutate(
-                self.mutation_probability,
-                self.next_point_diviation)
-        self.population.sort()
+            x = int(self.random.integers(num_selected))
+            y = int(self.random.integers(num_selected))
+            tasks.append((x, y))
+        if profiling:
+            clock = profiler.add_time('evolution.select', clock)
+
+        if self.store is not None:
+            self._evolve_store(tasks)
+            if profiling:
+                clock = profiler.add_time('evolution.breed', clock)
+        else:
+            seeds = self.random.integers(2**31 - 1, size=len(tasks))
+            best = self.population[:num_selected]
+            self.population = [best[0]] + self.breed(
+                best, [task + (seed,) for task, seed in zip(tasks, seeds)])
+            if profiling:
+                clock = profiler.add_time('evolution.breed', clock)
+            self.population.sort()
+        if profiling:
+            clock = profiler.add_time('evolution.sort', clock)
+            profiler.count('children', len(tasks))
         self.generation += 1
         self.log_generation_info()
+        if profiling:
+            profiler.add_time('evolution.log', clock)
+
+    def _evolve_store(self, tasks):
+        """(PathModel, [(int, int)]) -> NoneType
+
+        One generation in the arrays representation: the same tasks as
+        for breed(), done on the whole buffer at once.
+        """
+        best = self.store.take(range(min(self.num_to_choose, len(self.store))))
+        clones = best.take([men for men, woman in tasks if woman < 0])
+        pairs = [(men, woman) for men, woman in tasks if woman >= 0]
+        children = best.crossover([men for men, woman in pairs],
+                                  [woman for men, woman in pairs],
+                                  self.random)
+        offspring = Population.concatenate([clones, children])
+        offspring.mutate(
+            self.mutation_probability, self.next_point_diviation,
+            self.random)
+
+        self.store = Population.concatenate([best.take([0]), offspring])
+        self.store.evaluate(self.penalty_index, cache=self.fitness_cache)
+        self.store.sort()
+        self.population = None
+
+    def breed(self, parents, tasks):
+        """(PathModel, [Individual], [(int, int, int)]) -> [Individual]
+
+        Make, mutate and evaluate children in chunks of chunk_size, in
+        worker processes when there are more than one. Every child has
+        its own seed and cost, so the result doesn't depend on chunks or
+        workers.
+        With the fitness cache children are only made in chunks, looked
+        up in the cache here, where it is, and the ones missing in it are
+        evaluated by evaluate_chunks().
+
+        >>> config = {'window': {'size': [1000, 800]}, 'model': {
+        ...     'start': [200, 200], 'destination': [900, 600],
+        ...     'next_point_diviation': 200, 'mutation_probability': 0.2,
+        ...     'population_size': 50, 'num_to_choose': 5, 'mutate_best': 5,
+        ...     'points_in_path': [4, 10], 'seed': 0,
+        ...     'penalty_areas': [[[300, 300], 50], [[500, 200], 150]]}}
+        >>> def costs(**options):
+        ...     model = PathModel(dict(config, model=dict(
+        ...         config['model'], **options)))
+        ...     for _ in range(5):
+        ...         model.evolution()
+        ...     model.close()
+        ...     return [individual.cost for individual in model.population]
+        >>> costs(workers=1) == costs(workers=3, chunk_size=7)
+        True
+        >>> costs(penalty='segments') == costs(penalty='segments', workers=2)
+        True
+        """
+        evaluate = self.fitness_cache is None
+        parents_points = [numpy.array(p, dtype=float) for p in parents]
+        parents_costs = [p.cost for p in parents]
+        parents_segments = [
+            None if p._segment_inside is None
+            else (p._segment_lengths, p._segment_inside) for p in parents]
+        payloads = [
+            (parents_points, parents_costs, parents_segments,
+             tasks[begin:begin + self.chunk_size],
+             self.mutation_probability, self.next_point_diviation, evaluate)
+            for begin in range(0, len(tasks), self.chunk_size)]
+
+        if self.workers > 1:
+            results = self._pool().map(_breed_in_worker, payloads)
+        else:
+            results = (breed(payload, self.penalty_index)
+                       for payload in payloads)
+
+        children = []
+        for result in results:
+            children.extend(unpack_children(result, self.penalty_index))
+        if not evaluate:
+            self.evaluate(children)
+        return children
+
+    def best_paths(self, n):
+        """(PathModel, int) -> [(K, 2) numpy.array]
+
+        Copies of the n best paths, to send to another population.
+        """
+        if self.store is not None:
+            return [self.store.path(row).copy()
+                    for row in range(min(n, len(self.store)))]
+        return [numpy.array(i, dtype=float) for i in self.population[:n]]
+
+    def immigrate(self, paths):
+        """(PathModel, [(K, 2) array like]) -> NoneType
+
+        Replace the worst individuals with the given paths, the
+        population keeps its size and stays sorted.
+        """
+        paths = paths[:self.population_size - 1]
+        if not paths:
+            return
+        if self.store is not None:
+            newcomers = Population.from_paths(paths)
+            newcomers.evaluate(self.penalty_index, cache=self.fitness_cache)
+            self.store = Population.concatenate([
+                self.store.take(range(len(self.store) - len(paths))),
+                newcomers])
+            self.store.sort()
+            self.population = None
+        else:
+            newcomers = [Individual(numpy.array(path, dtype=float))
+                         for path in paths]
+            for individual in newcomers:
+                individual.set_penalty_areas(self.penalty_index)
+            self.evaluate(newcomers)
+            self.population = (
+                self.population[:len(self.population) - len(paths)] +
+                newcomers)
+            self.population.sort()
+
+    def state(self):
+        """(PathModel) -> dict
+
+        Everything needed to continue the run on a model built from the
+        same config: population, generation, the random state
+        and the fitness cache. A run resumed from a checkpoint goes on
+        exactly as if it was never stopped:
+
+        >>> import os, tempfile, checkpoint
+        >>> path = os.path.join(tempfile.mkdtemp(), 'run.npz')
+        >>> config = {'window': {'size': [1000, 800]}, 'model': {
+        ...     'start': [200, 200], 'destination': [900, 600],
+        ...     'next_point_diviation': 200, 'mutation_probability': 0.2,
+        ...     'population_size': 30, 'num_to_choose': 5, 'mutate_best': 5,
+        ...     'points_in_path': [4, 10], 'seed': 0,
+        ...     'fitness_cache_size': 64,
+        ...     'penalty_areas': [[[300, 300], 50], [[500, 200], 150]]}}
+        >>> def costs(model, generations):
+        ...     for _ in range(generations):
+        ...         model.evolution()
+        ...     return [individual.cost for individual in model.population]
+        >>> for representation in ('individuals', 'arrays'):
+        ...     options = dict(config['model'], representation=representation)
+        ...     model_config = dict(config, model=options)
+        ...     expected = costs(PathModel(model_config), 6)
+        ...     model = PathModel(model_config)
+        ...     _ = costs(model, 3)
+        ...     checkpoint.save(path, model.state())
+        ...     resumed = PathModel(model_config)
+        ...     resumed.load_state(checkpoint.load(path))
+        ...     print(costs(resumed, 3) == expected)
+        True
+        True
+        """
+        state = {
+            'generation': self.generation,
+            'penalty_digest': self.penalty_index.digest.hex(),
+            'random': self.random.bit_generator.state,
+        }
+        if self.store is not None:
+            store = self.store
+            state['store'] = {
+                'points': store.points.copy(),
+                'sizes': store.sizes.copy(),
+                'costs': store.costs.copy(),
+                'lengths': store.lengths.copy(),
+                'penalties': store.penalties.copy(),
+                'penalty_points': numpy.concatenate(
+                    [numpy.zeros((0, 2), dtype=int)] +
+                    [numpy.asarray(p, dtype=int).reshape(-1, 2)
+                     for p in store.penalty_points]),
+            }
+        else:
+            sizes = numpy.array([len(i) for i in self.population])
+            state['population'] = dict(pack_fitness([
+                tuple(getattr(i, name) for name in FITNESS_FIELDS)
+                for i in self.population]),
+                points=numpy.concatenate(
+                    [numpy.array(i, dtype=float) for i in self.population]),
+                sizes=sizes)
+        if self.fitness_cache is not None:
+            items = self.fitness_cache.items()
+            state['fitness_cache'] = dict(pack_fitness(
+                [value for key, value in items]),
+                keys=numpy.frombuffer(
+                    b''.join(key for key, value in items), dtype=numpy.uint8
+                ).reshape(-1, FitnessCache.KEY_SIZE),
+                hits=self.fitness_cache.hits,
+                misses=self.fitness_cache.misses)
+        return state
+
+    def load_state(self, state):
+        """(PathModel, dict) -> NoneType
+        """
+        if state['penalty_digest'] != self.penalty_index.digest.hex():
+            raise ValueError('State was saved for other penalty areas')
+        self.generation = int(state['generation'])
+        self.random.bit_generator.state = state['random']
+
+        if 'store' in state:
+            store = state['store']
+            self.store = Population(
+                numpy.array(store['points']), store['sizes'],
+                store['costs'], store['lengths'], store['penalties'],
+                numpy.split(store['penalty_points'],
+                            numpy.cumsum(store['penalties'])[:-1]))
+            self.population = None
+        else:
+            population = state['population']
+            sizes = population['sizes']
+            self.population = []
+            for points, fitness in zip(
+                    numpy.split(population['points'],
+                                numpy.cumsum(sizes)[:-1]),
+                    unpack_fitness(population)):
+                individual = Individual(points)
+                individual.set_penalty_areas(self.penalty_index)
+                for name, value in zip(FITNESS_FIELDS, fitness):
+                    setattr(individual, name, value)
+                self.population.append(individual)
+
+        if self.fitness_cache is not None and 'fitness_cache' in state:
+            cache = state['fitness_cache']
+            self.fitness_cache = FitnessCache(self.fitness_cache.size)
+            for key, fitness in zip(cache['keys'],
+                                    unpack_fitness(cache)):
+                self.fitness_cache.put(key.tobytes(), fitness)
+            self.fitness_cache.hits = int(cache['hits'])
+            self.fitness_cache.misses = int(cache['misses'])
+
+    def close(self):
+        """(PathModel) -> NoneType
+
+        Stop worker processes if any.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
 
     def crossover(self, first, second):
         child_len = int((len(first) + len(second)) / 2)
@@ -238,3 +956,7 @@ class PathModel(object):
         child.append(first[-1])
 
         return child
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
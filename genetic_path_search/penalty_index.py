@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""Spatial index of circular penalty areas.
+
+Penalty areas are compiled once into a uniform grid: every circle is
+registered in the cells its bounding box overlaps, so a point or a
+segment is tested only against circles from the cells it touches.
+The 'brute' mode tests everything against every circle and serves as
+a reference for the grid:
+
+    >>> rng = numpy.random.RandomState(0)
+    >>> areas = [(tuple(center), R) for center, R in zip(
+    ...     rng.rand(300, 2) * 1000, rng.rand(300) * 40 + 5)]
+    >>> grid, brute = PenaltyIndex(areas), PenaltyIndex(areas, 'brute')
+    >>> points = rng.rand(10000, 2) * 1000
+    >>> numpy.array_equal(grid.points_inside(points),
+    ...                   brute.points_inside(points))
+    True
+    >>> starts, ends = rng.rand(2, 2000, 2) * 1000
+    >>> numpy.allclose(grid.segments_inside(starts, ends)[0],
+    ...                brute.segments_inside(starts, ends)[0])
+    True
+"""
+
+import hashlib
+
+import numpy
+
+
+MODES = ('grid', 'brute')
+PENALTIES = ('samples', 'segments')
+
+
+def _expand(counts):
+    """(numpy.array) -> (numpy.array, numpy.array)
+
+    For every item repeated counts times return its index and the number
+    of the repetition.
+    """
+    owners = numpy.repeat(numpy.arange(len(counts)), counts)
+    steps = numpy.arange(counts.sum()) - numpy.repeat(
+        numpy.cumsum(counts) - counts, counts)
+    return owners, steps
+
+
+class PenaltyIndex(object):
+    def __init__(self, areas, mode='grid', cell_size=None,
+                 penalty='samples'):
+        """(PenaltyIndex, [((x, y), R)], str, float, str) -> NoneType
+
+        penalty tells how paths are penalized: 'samples' counts sample
+        points inside areas, 'segments' measures exact length of path
+        segments inside areas.
+        """
+        if mode not in MODES:
+            raise ValueError('Unknown penalty index mode: {0}'.format(mode))
+        if penalty not in PENALTIES:
+            raise ValueError('Unknown penalty: {0}'.format(penalty))
+        self.areas = areas
+        self.mode = mode
+        self.penalty = penalty
+
+        centers = numpy.array([center for center, R in areas], dtype=float)
+        self.centers = centers.reshape(-1, 2)
+        self.radii = numpy.array([R for center, R in areas], dtype=float)
+        # Identifies the areas and the penalty, but not the way they are
+        # searched: grid and brute modes give the same costs.
+        self.digest = hashlib.blake2b(
+            self.centers.tobytes() + self.radii.tobytes() +
+            self.penalty.encode(), digest_size=16).digest()
+
+        if self.mode == 'grid' and len(self.radii):
+            self._build_grid(cell_size)
+
+    def __len__(self):
+        return len(self.radii)
+
+    def _build_grid(self, cell_size):
+        if cell_size is None:
+            cell_size = 2 * self.radii.mean()
+        self.cell_size = float(max(cell_size, 1e-9))
+
+        low = self.centers - self.radii[:, numpy.newaxis]
+        high = self.centers + self.radii[:, numpy.newaxis]
+        self.origin = low.min(axis=0)
+        self.shape = (numpy.floor((high.max(axis=0) - self.origin) /
+                                  self.cell_size).astype(int) + 1)
+
+        first = self._cells(low)
+        last = self._cells(high)
+        span = last - first + 1
+        circles, steps = _expand(span[:, 0] * span[:, 1])
+        cells = first[circles] + numpy.stack(
+            (steps % span[circles, 0], steps // span[circles, 0]), axis=1)
+        keys = cells[:, 1] * self.shape[0] + cells[:, 0]
+
+        order = numpy.argsort(keys, kind='stable')
+        self.cell_circles = circles[order]
+        self.cell_count = numpy.bincount(
+            keys, minlength=self.shape[0] * self.shape[1])
+        self.cell_start = numpy.cumsum(self.cell_count) - self.cell_count
+
+    def _cells(self, points):
+        cells = numpy.floor((points - self.origin) / self.cell_size)
+        return numpy.clip(cells, 0, self.shape - 1).astype(int)
+
+    def _outside_grid(self, low, high):
+        return ((high < self.origin) |
+                (low >= self.origin + self.shape * self.cell_size)).any(axis=1)
+
+    def _cell_candidates(self, keys):
+        """For every key return (owner index, circle) pairs of its cell.
+        """
+        owners, steps = _expand(self.cell_count[keys])
+        return owners, self.cell_circles[self.cell_start[keys][owners] + steps]
+
+    def points_inside(self, points, chunk=2**20):
+        """(PenaltyIndex, (K, 2) numpy.array) -> (K,) numpy.array
+
+        Whether every point lies strictly inside some penalty area.
+        """
+        points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+        inside = numpy.zeros(len(points), dtype=bool)
+        if not len(self) or not len(points):
+            return inside
+
+        if self.mode == 'brute':
+            step = max(1, chunk // len(self))
+            for begin in range(0, len(points), step):
+                diff = (points[begin:begin + step, numpy.newaxis, :] -
+                        self.centers[numpy.newaxis, :, :])
+                inside[begin:begin + step] = (
+                    (diff ** 2).sum(axis=2) < self.radii ** 2).any(axis=1)
+            return inside
+
+        near = numpy.flatnonzero(~self._outside_grid(points, points))
+        cells = self._cells(points[near])
+        owners, circles = self._cell_candidates(
+            cells[:, 1] * self.shape[0] + cells[:, 0])
+        owners = near[owners]
+        diff = points[owners] - self.centers[circles]
+        hit = (diff ** 2).sum(axis=1) < self.radii[circles] ** 2
+        inside[owners[hit]] = True
+        return inside
+
+    def segment_candidates(self, starts, ends):
+        """(PenaltyIndex, (K, 2) numpy.array, (K, 2) numpy.array)
+            -> ((M,) numpy.array, (M,) numpy.array)
+
+        Unique pairs of (segment, circle) where the circle may touch the
+        segment: in the grid mode they share a cell of the segment's
+        bounding box, in the brute mode all pairs are returned.
+        """
+        starts = numpy.asarray(starts, dtype=float).reshape(-1, 2)
+        ends = numpy.asarray(ends, dtype=float).reshape(-1, 2)
+        if not len(self) or not len(starts):
+            empty = numpy.zeros(0, dtype=int)
+            return empty, empty
+
+        if self.mode == 'brute':
+            segments = numpy.repeat(numpy.arange(len(starts)), len(self))
+            circles = numpy.tile(numpy.arange(len(self)), len(starts))
+            return segments, circles
+
+        low = numpy.minimum(starts, ends)
+        high = numpy.maximum(starts, ends)
+        near = numpy.flatnonzero(~self._outside_grid(low, high))
+        first = self._cells(low[near])
+        span = self._cells(high[near]) - first + 1
+
+        owners, steps = _expand(span[:, 0] * span[:, 1])
+        cells = first[owners] + numpy.stack(
+            (steps % span[owners, 0], steps // span[owners, 0]), axis=1)
+        cell_owners, circles = self._cell_candidates(
+            cells[:, 1] * self.shape[0] + cells[:, 0])
+        segments = near[owners[cell_owners]]
+
+        pairs = numpy.unique(segments * len(self) + circles)
+        return pairs // len(self), pairs % len(self)
+
+    def segments_inside(self, starts, ends):
+        """(PenaltyIndex, (K, 2) numpy.array, (K, 2) numpy.array)
+            -> ((K,) numpy.array, (M,) numpy.array, (M, 2) numpy.array,
+                (M, 2) numpy.array)
+
+        Exact length of every segment inside the union of penalty areas.
+        Also returns pieces of segments inside areas: segment index,
+        entry and exit point of every piece, ordered by segment.
+        """
+        starts = numpy.asarray(starts, dtype=float).reshape(-1, 2)
+        ends = numpy.asarray(ends, dtype=float).reshape(-1, 2)
+        segments, circles = self.segment_candidates(starts, ends)
+
+        # Solve |start + t * direction - center| = R for t in [0, 1].
+        direction = ends[segments] - starts[segments]
+        offset = starts[segments] - self.centers[circles]
+        a = (direction ** 2).sum(axis=1)
+        b = 2 * (offset * direction).sum(axis=1)
+        c = (offset ** 2).sum(axis=1) - self.radii[circles] ** 2
+        discriminant = b ** 2 - 4 * a * c
+        crossing = (discriminant > 0) & (a > 0)
+        segments, a, b = segments[crossing], a[crossing], b[crossing]
+        root = numpy.sqrt(discriminant[crossing])
+        enter = numpy.clip((-b - root) / (2 * a), 0., 1.)
+        leave = numpy.clip((-b + root) / (2 * a), 0., 1.)
+        crossing = leave > enter
+        segments = segments[crossing]
+        enter, leave = enter[crossing], leave[crossing]
+
+        # Union of intervals of every segment. Complex numbers are
+        # ordered by the real part first, so one running maximum of
+        # segment + 1j * leave over intervals sorted by segment is the
+        # running maximum of leave within every segment.
+        order = numpy.lexsort((leave, enter, segments))
+        segments, enter, leave = segments[order], enter[order], leave[order]
+        reached = numpy.concatenate((
+            [-1.], numpy.maximum.accumulate(segments + 1j * leave)[:-1]))
+        reached = numpy.where(reached.real == segments, reached.imag,
+                              -numpy.inf)
+        inside = numpy.maximum(leave - numpy.maximum(enter, reached), 0.)
+
+        lengths = numpy.hypot(*(ends - starts).T)
+        inside_length = numpy.bincount(
+            segments, inside, minlength=len(starts)) * lengths
+
+        first = numpy.flatnonzero(enter > reached)
+        last = numpy.maximum.reduceat(leave, first) if len(first) else leave
+        pieces = segments[first]
+        direction = (ends - starts)[pieces]
+        enter = enter[first][:, numpy.newaxis]
+        leave = last[:, numpy.newaxis]
+        entries = starts[pieces] + enter * direction
+        exits = starts[pieces] + leave * direction
+        return inside_length, pieces, entries, exits
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
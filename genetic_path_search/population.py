@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""Structure of arrays representation of a population of paths.
+
+All paths live in one padded (P, width, 2) buffer, path sizes, costs,
+lengths and penalty counts are held in parallel arrays. Crossover,
+mutation, selection and evaluation work on the whole buffer with NumPy
+instead of allocating an object per point.
+"""
+
+import numpy
+
+from instrument import profiler
+from penalty_index import _expand
+
+
+def _event_counts(prob, size, rng):
+    """(numpy.array, int, Generator) -> numpy.array
+
+    How many times `while prob > rng.random()` loop runs, drawn at once
+    from the geometric distribution.
+    """
+    prob = numpy.clip(prob, 0., 1. - 1e-12)
+    u = 1. - rng.random(size)
+    counts = numpy.zeros(size, dtype=int)
+    positive = prob > 0
+    counts[positive] = numpy.floor(
+        numpy.log(u[positive]) / numpy.log(prob[positive]))
+    return counts
+
+
+def evaluate_paths(points, sizes, penalty_index, delta=10.):
+    """((K, 2) numpy.array, (P,) numpy.array, PenaltyIndex, float) -> tuple
+
+    Cost of paths given by their points joined back to back. Every path
+    is measured from its own start, so its cost is the same whatever
+    paths are evaluated with it.
+
+    With 'samples' penalty of the index every path is sampled each delta
+    units of its length; samples are interpolated on cumulative segment
+    lengths and tested against the penalty areas in one query. Cost is
+    length * exp(samples inside areas).
+
+    With 'segments' penalty all segments are intersected with the areas
+    exactly and cost is length * exp(length inside areas / delta), so it
+    doesn't depend on the number of samples. Penalty points are then
+    entries to and exits from areas.
+
+    Returns lengths, costs and penalty point counts of the paths,
+    penalty points of all paths ordered by path, length of every path
+    segment ordered by path and, for 'segments' penalty, length of every
+    segment inside areas (None otherwise).
+    """
+    starts = numpy.cumsum(sizes) - sizes
+    # Links between paths joined back to back are not segments.
+    links = numpy.ones(len(points) - 1, dtype=bool)
+    links[starts[1:] - 1] = False
+    segments = numpy.hypot(*numpy.diff(points, axis=0)[links].T)
+
+    owners, steps = _expand(sizes - 1)
+    padded = numpy.zeros((len(sizes), sizes.max()))
+    padded[owners, steps + 1] = segments
+    cumulative = numpy.cumsum(padded, axis=1)
+    lengths = cumulative[numpy.arange(len(sizes)), sizes - 1]
+
+    if penalty_index.penalty == 'segments':
+        inside, pieces, entries, exits = penalty_index.segments_inside(
+            points[:-1][links], points[1:][links])
+        inside_length = numpy.bincount(owners, inside, minlength=len(sizes))
+        costs = lengths * numpy.exp(inside_length / delta)
+
+        penalty_points = numpy.stack((entries, exits), axis=1).reshape(-1, 2)
+        penalties = 2 * numpy.bincount(owners[pieces], minlength=len(sizes))
+        return (lengths, costs, penalties, penalty_points.astype(int),
+                segments, inside)
+
+    counts = numpy.maximum((lengths / delta).astype(int) - 1, 0)
+    owners, steps = _expand(counts)
+    positions = (steps + 1) * delta
+
+    # Complex numbers are ordered by the real part first, so the real
+    # part keeps rows apart and every sample is searched for in the
+    # cumulative lengths of its own path only.
+    rows = numpy.arange(len(sizes))[:, numpy.newaxis]
+    right = numpy.searchsorted(
+        (rows + 1j * cumulative).ravel(), owners + 1j * positions,
+        side='right') - owners * cumulative.shape[1]
+    right = numpy.clip(right, 1, sizes[owners] - 1)
+    left = right - 1
+    ratio = ((positions - cumulative[owners, left]) /
+             numpy.maximum(padded[owners, right], 1e-12))[:, numpy.newaxis]
+    left = starts[owners] + left
+    samples = points[left] * (1. - ratio) + points[left + 1] * ratio
+
+    inside = penalty_index.points_inside(samples)
+
+    penalties = numpy.bincount(owners[inside], minlength=len(sizes))
+    costs = lengths * numpy.exp(penalties)
+    return (lengths, costs, penalties, samples[inside].astype(int),
+            segments, None)
+
+
+class Population(object):
+    """Population -- paths of a whole population in one padded buffer.
+
+    points[i, :sizes[i]] is the i-th path, the rest of the row is
+    padding. Cost is nan until the path is evaluated.
+    """
+    def __init__(self, points, sizes, costs=None, lengths=None,
+                 penalties=None, penalty_points=None):
+        self.points = points
+        self.sizes = numpy.asarray(sizes, dtype=int)
+        count = len(self.sizes)
+        self.costs = (numpy.full(count, numpy.nan) if costs is None
+                      else numpy.asarray(costs, dtype=float))
+        self.lengths = (numpy.full(count, numpy.nan) if lengths is None
+                        else numpy.asarray(lengths, dtype=float))
+        self.penalties = (numpy.zeros(count, dtype=int) if penalties is None
+                          else numpy.asarray(penalties, dtype=int))
+        self.penalty_points = (
+            [numpy.zeros((0, 2), dtype=int)] * count
+            if penalty_points is None else list(penalty_points))
+
+    @classmethod
+    def from_paths(cls, paths):
+        """([(N, 2) array like]) -> Population
+        """
+        sizes = numpy.array([len(path) for path in paths])
+        points = numpy.zeros((len(paths), sizes.max(), 2))
+        for row, path in enumerate(paths):
+            points[row, :len(path)] = numpy.asarray(path, dtype=float)
+        return cls(points, sizes)
+
+    @classmethod
+    def concatenate(cls, populations):
+        """([Population]) -> Population
+        """
+        width = max(p.points.shape[1] for p in populations)
+        points = numpy.concatenate([
+            numpy.pad(p.points, ((0, 0), (0, width - p.points.shape[1]),
+                                 (0, 0)))
+            for p in populations])
+        return cls(
+            points,
+            numpy.concatenate([p.sizes for p in populations]),
+            numpy.concatenate([p.costs for p in populations]),
+            numpy.concatenate([p.lengths for p in populations]),
+            numpy.concatenate([p.penalties for p in populations]),
+            sum((p.penalty_points for p in populations), []))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def path(self, row):
+        """(Population, int) -> (N, 2) numpy.array
+
+        View of the row's path in the buffer.
+        """
+        return self.points[row, :self.sizes[row]]
+
+    def _mask(self):
+        return (numpy.arange(self.points.shape[1]) <
+                self.sizes[:, numpy.newaxis])
+
+    def _reserve(self, width):
+        if width > self.points.shape[1]:
+            self.points = numpy.pad(
+                self.points,
+                ((0, 0), (0, max(width, 2 * self.points.shape[1]) -
+                          self.points.shape[1]), (0, 0)))
+
+    def take(self, rows):
+        """(Population, [int]) -> Population
+
+        Copy of the given rows, e.g. the selected parents.
+        """
+        rows = numpy.asarray(rows, dtype=int)
+        width = max(self.sizes[rows].max(), 2) if len(rows) else 2
+        return Population(
+            self.points[rows, :width].copy(), self.sizes[rows],
+            self.costs[rows], self.lengths[rows], self.penalties[rows],
+            [self.penalty_points[row] for row in rows])
+
+    def sort(self):
+        """(Population) -> NoneType
+
+        Order rows by cost, the best first.
+        """
+        order = numpy.argsort(self.costs, kind='stable')
+        self.points = self.points[order]
+        self.sizes = self.sizes[order]
+        self.costs = self.costs[order]
+        self.lengths = self.lengths[order]
+        self.penalties = self.penalties[order]
+        self.penalty_points = [self.penalty_points[row] for row in order]
+
+    def evaluate(self, penalty_index, delta=10., cache=None):
+        """(Population, PenaltyIndex, float, FitnessCache) -> NoneType
+
+        Calculate cost of all rows which don't know it yet. Rows found in
+        the cache are not evaluated again. Entries are the same as these
+        of individuals, path_model.FITNESS_FIELDS values, so a cache
+        saved with either representation serves both.
+        """
+        rows = numpy.flatnonzero(numpy.isnan(self.costs))
+        keys = []
+        if cache is not None and len(rows):
+            missing = []
+            for row in rows.tolist():
+                key = cache.key(self.path(row), penalty_index, delta)
+                fitness = cache.get(key)
+                if fitness is None:
+                    missing.append(row)
+                    keys.append(key)
+                    continue
+                self.costs[row], self.lengths[row] = fitness[:2]
+                self.penalty_points[row] = numpy.array(
+                    fitness[2], dtype=int).reshape(-1, 2)
+                self.penalties[row] = len(self.penalty_points[row])
+            if profiler.enabled:
+                profiler.count('cache.hits', len(rows) - len(missing))
+                profiler.count('cache.misses', len(missing))
+            rows = numpy.array(missing, dtype=int)
+        if not len(rows):
+            return
+        if profiler.enabled:
+            profiler.count('evaluations', len(rows))
+        sizes = self.sizes[rows]
+        mask = self._mask()[rows]
+        (lengths, costs, penalties, penalty_points, segments,
+         segment_inside) = evaluate_paths(
+             self.points[rows][mask], sizes, penalty_index, delta)
+        self.lengths[rows] = lengths
+        self.costs[rows] = costs
+        self.penalties[rows] = penalties
+        for row, ppoints in zip(rows, numpy.split(
+                penalty_points, numpy.cumsum(penalties)[:-1])):
+            self.penalty_points[row] = ppoints
+
+        ends = numpy.cumsum(sizes - 1)
+        for number, (row, key, start, end) in enumerate(
+                zip(rows, keys, ends - sizes + 1, ends)):
+            known = segment_inside is not None
+            cache.put(key, (
+                float(costs[number]), float(lengths[number]),
+                list(self.penalty_points[row]),
+                segments[start:end] if known else None,
+                segment_inside[start:end] if known else None))
+
+    def _ratios(self):
+        """Cumulative length of every point divided by the path length,
+        padding is 1.
+        """
+        diff = numpy.diff(self.points, axis=1)
+        segments = numpy.hypot(diff[..., 0], diff[..., 1])
+        segments[~self._mask()[:, 1:]] = 0.
+        cumulative = numpy.concatenate(
+            (numpy.zeros((len(self), 1)), numpy.cumsum(segments, axis=1)),
+            axis=1)
+        total = cumulative[numpy.arange(len(self)), self.sizes - 1]
+        ratios = cumulative / numpy.maximum(total, 1e-12)[:, numpy.newaxis]
+        ratios[~self._mask()] = 1.
+        return ratios
+
+    def points_by_ratio(self, rows, ratios):
+        """(Population, (K,) numpy.array, (K,) numpy.array) -> (K, 2) array
+
+        Points dividing paths of the given rows in the given ratios. All
+        rows are searched at once: row r owns the range [r, r + 1] of
+        the flattened cumulative ratios.
+        """
+        width = self.points.shape[1]
+        flat = (numpy.arange(len(self))[:, numpy.newaxis] +
+                self._ratios()).ravel()
+        ratios = numpy.clip(ratios, 0., 1.)
+        index = numpy.searchsorted(flat, rows + ratios, side='right')
+        right = numpy.clip(index - rows * width, 1, self.sizes[rows] - 1)
+        left = right - 1
+
+        lo = flat[rows * width + left] - rows
+        hi = flat[rows * width + right] - rows
+        coeff = numpy.clip((ratios - lo) / numpy.maximum(hi - lo, 1e-12),
+                           0., 1.)[:, numpy.newaxis]
+        return (self.points[rows, left] * (1. - coeff) +
+                self.points[rows, right] * coeff)
+
+    def crossover(self, men, women, rng):
+        """(Population, [int], [int], Generator) -> Population
+
+        Children of rows men[i] and women[i], every point of a child is
+        a cost weighted mix of points at the same length ratio of both
+        parents. Same rule as Individual.make_child.
+        """
+        men = numpy.asarray(men, dtype=int)
+        women = numpy.asarray(women, dtype=int)
+        if not len(men):
+            return Population(numpy.zeros((0, 2, 2)), [])
+        sizes = (self.sizes[men] + self.sizes[women]) // 2
+
+        owners, steps = _expand(sizes - 2)
+        ratios = (steps + 1.) / (sizes[owners] - 1)
+        first = self.points_by_ratio(men[owners], ratios)
+        second = self.points_by_ratio(women[owners], ratios)
+
+        men_cost = self.costs[men][owners, numpy.newaxis]
+        women_cost = self.costs[women][owners, numpy.newaxis]
+        total_cost = men_cost + women_cost
+        k = (numpy.minimum(men_cost, women_cost) *
+             (0.6 * rng.random((len(owners), 1)) - 0.3))
+
+        points = numpy.zeros((len(men), sizes.max(), 2))
+        points[:, 0] = self.points[men, 0]
+        points[owners, steps + 1] = (first * ((men_cost - k) / total_cost) +
+                                     second * ((women_cost + k) / total_cost))
+        points[numpy.arange(len(men)), sizes - 1] = \
+            self.points[men, self.sizes[men] - 1]
+        return Population(points, sizes)
+
+    def mutate(self, prob, diviation, rng):
+        """(Population, float, float, Generator) -> NoneType
+
+        Same mutations as Individual.mutate for every row: shift of a
+        point with its neighbours, insertion of a point after a random
+        one and removal of a random inner point. Numbers of events are
+        drawn at once, only rows with insertions or removals are
+        processed one by one.
+        """
+        count = len(self)
+        if not count:
+            return
+        sizes = self.sizes
+        prob = numpy.where(sizes == 2, prob / 3.,
+                           prob / numpy.maximum(sizes - 2, 1) / 3.)
+        changed = numpy.zeros(count, dtype=bool)
+
+        # Change point mutation
+        shifts = _event_counts(numpy.where(sizes > 5, prob, 0.), count, rng)
+        rows, _ = _expand(shifts)
+        if len(rows):
+            x = 2 + (rng.random(len(rows)) * (sizes[rows] - 5)).astype(int)
+            mutation = diviation * rng.standard_normal((len(rows), 2))
+            numpy.add.at(self.points, (rows, x), mutation * 0.5)
+            numpy.add.at(self.points, (rows, x - 1), mutation * 0.2)
+            numpy.add.at(self.points, (rows, x + 1), mutation * 0.2)
+            changed[rows] = True
+
+        # Add and remove point mutations
+        inserts = _event_counts(prob, count, rng)
+        removals = _event_counts(prob, count, rng)
+        self._reserve((sizes + inserts).max())
+        for row in numpy.flatnonzero(inserts + removals):
+            path = self.points[row]
+            size = sizes[row]
+            edited = inserts[row] > 0
+            for _ in range(inserts[row]):
+                x = int(rng.random() * (size - 1))
+                middle = (path[x] + path[x + 1]) / 2
+                path[x + 2:size + 1] = path[x + 1:size].copy()
+                path[x + 1] = middle + diviation * rng.standard_normal(2)
+                size += 1
+            for _ in range(removals[row]):
+                if size <= 2:
+                    break
+                x = 1 + int(rng.random() * (size - 2))
+                path[x:size - 1] = path[x + 1:size].copy()
+                size -= 1
+                edited = True
+            changed[row] |= edited
+            sizes[row] = size
+
+        self.costs[changed] = numpy.nan
+        self.lengths[changed] = numpy.nan
+        self.penalties[changed] = 0
@@ -1,13 +1,19 @@
 import os
+import time
 import yaml
 import pygame
 import argparse
+import threading
+import collections
 import logging
 
 from colors import *
 from model import *
 
+import tsplib
 import event_handler
+from schedules import StopRule
+import instrument
 
 
 class CommonSprite(pygame.sprite.Sprite):
@@ -38,23 +44,44 @@ class Chart(CommonSprite):
 
         self._show_best = False
         self._auto_update = False
+        self._towns = None
+        self._iteration = None
+        self._dirty = True
 
     def toggle_auto_update(self):
         self._auto_update = not self._auto_update
 
     def toggle_show_best(self):
         self._show_best = not self._show_best
+        self._dirty = True
 
-    def redraw(self, model):
-        self.image.fill(to_color(self.bgcolor))
-
-        for town in model.route:
+    def _draw_towns(self, towns):
+        """Towns never move, they are drawn once.
+        """
+        self._towns = pygame.Surface(self.size)
+        self._towns.fill(to_color(self.bgcolor))
+        for town in towns:
             pygame.draw.circle(
-                self.image,
+                self._towns,
                 to_color(self.town_color),
                 numpy.array(town, dtype=int),
                 self.town_size)
 
+    def redraw(self, model):
+        """(Chart, Snapshot) -> bool
+
+        Draw the routes unless the chart already shows this iteration.
+        Returns whether anything was drawn.
+        """
+        if not self._dirty and model.iteration == self._iteration:
+            return False
+        self._dirty = False
+        self._iteration = model.iteration
+
+        if self._towns is None:
+            self._draw_towns(model.route)
+        self.image.blit(self._towns, (0, 0))
+
         if self._show_best:
             pygame.draw.lines(
                 self.image,
@@ -69,6 +96,114 @@ class Chart(CommonSprite):
                 True,
                 model.route,
                 2)
+        return True
+
+
+Snapshot = collections.namedtuple(
+    'Snapshot', ['route', 'best', 'tick', 'iteration', 'rate'])
+
+
+class Annealer(object):
+    """Annealer -- runs the model in batches and keeps a snapshot of it.
+
+    A batch is a number of iterations or, when frame_time is set, as
+    many iterations as fit into that many seconds. Batches run either
+    in step() called once per frame or on a background thread. The
+    renderer only reads the latest snapshot, so it never waits for the
+    model and the model never waits for the renderer.
+
+    Once the stop rule, if any, says the run is over, batches do nothing
+    and stopped holds the reason.
+    """
+    def __init__(self, model, iterations=1000, frame_time=None, stop=None):
+        self.model = model
+        self.iterations = iterations
+        self.frame_time = frame_time
+        self.stop_rule = stop
+        self.stopped = None
+        if stop is not None:
+            stop.start(model)
+        self.running = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+        self.snapshot = self._take(0.)
+
+    def _take(self, rate):
+        return Snapshot(self.model.route, self.model.best,
+                        self.model.tick, self.model.iteration, rate)
+
+    def _steps(self, most):
+        if self.stop_rule is None:
+            return most
+        return self.stop_rule.steps(self.model, most)
+
+    def _batch(self):
+        if self.stopped is not None:
+            return
+        start = time.time()
+        iteration = self.model.iteration
+        if self.frame_time is None:
+            self.model.update_many(self._steps(self.iterations))
+        else:
+            while time.time() - start < self.frame_time:
+                self.model.update_many(
+                    self._steps(max(64, self.model.block_size)))
+                if self.stop_rule is not None and self.stop_rule.reason(
+                        self.model) is not None:
+                    break
+        spent = time.time() - start
+        rate = (self.model.iteration - iteration) / spent if spent else 0.
+        if self.stop_rule is not None:
+            self.stopped = self.stop_rule.reason(self.model)
+            if self.stopped is not None:
+                logging.info('Annealing stopped by %s at iteration %d',
+                             self.stopped, self.model.iteration)
+        self.snapshot = self._take(rate)
+
+    def update(self):
+        """(Annealer) -> NoneType
+
+        Single iteration, for stepping by hand.
+        """
+        with self._lock:
+            self.model.update()
+            self.snapshot = self._take(self.snapshot.rate)
+
+    def step(self):
+        """(Annealer) -> NoneType
+
+        One batch in the calling thread.
+        """
+        profiling = profiler.enabled
+        if profiling:
+            clock = profiler.clock()
+        with self._lock:
+            self._batch()
+        if profiling:
+            profiler.add_time('annealer.batch', clock)
+
+    def start(self):
+        """(Annealer) -> NoneType
+
+        Run batches on a background thread while running is set.
+        """
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            if self.stopped is not None:
+                # Converged, nothing to burn the CPU for.
+                time.sleep(0.1)
+            elif self.running.wait(0.1):
+                self.step()
+
+    def stop(self):
+        self._stopped = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
 
 
 def init_window(config):
@@ -80,19 +215,57 @@ def init_window(config):
 
 def loop(window, config):
     chart = Chart(config)
-    route = SalesmanRoute(config)
-    while True:
-        for event in pygame.event.get():
-            event_handler.handle_event(event, route, chart)
-        if chart._auto_update:
-            route.update()
-
-        pygame.display.set_caption(
-            config['window']['caption'] + " TICK: {0}".format(route.tick))
-        chart.redraw(route)
-        chart.draw(window)
-        pygame.display.flip()
-        pygame.time.delay(5)
+    options = config.get('app', {})
+    towns = None
+    if config['model'].get('instance'):
+        # Uniform scaling keeps the tours the same, only fits them in.
+        towns = tsplib.fit_to_window(
+            tsplib.load(config['model']['instance']).towns,
+            config['window']['size'])
+    stop = StopRule.from_config(config)
+    annealer = Annealer(
+        SalesmanRoute(config, towns),
+        options.get('iterations_per_frame', 1000),
+        options.get('frame_time'),
+        stop if stop else None)
+    background = options.get('background', False)
+    if background:
+        annealer.start()
+    try:
+        while True:
+            profiling = profiler.enabled
+            if profiling:
+                clock = profiler.clock()
+            for event in pygame.event.get():
+                event_handler.handle_event(event, annealer, chart)
+            if profiling:
+                clock = profiler.add_time('frame.events', clock)
+            if background:
+                if chart._auto_update:
+                    annealer.running.set()
+                else:
+                    annealer.running.clear()
+            elif chart._auto_update:
+                annealer.step()
+                if profiling:
+                    clock = profiler.add_time('frame.model', clock)
+
+            snapshot = annealer.snapshot
+            pygame.display.set_caption(
+                config['window']['caption'] +
+                " TICK: {0} IT/S: {1:.0f}".format(
+                    snapshot.tick, snapshot.rate) +
+                ("" if annealer.stopped is None else
+                 " STOPPED: {0}".format(annealer.stopped)))
+            if chart.redraw(snapshot):
+                chart.draw(window)
+                pygame.display.flip()
+            if profiling:
+                profiler.add_time('frame.render', clock)
+                profiler.count('frames')
+            pygame.time.delay(5)
+    finally:
+        annealer.stop()
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -101,15 +274,20 @@ def parse_args():
         default=os.path.join(os.path.dirname(__file__), 'config.yaml'),
         type=argparse.FileType('rt'),
         help='path to config')
+    instrument.add_arguments(parser)
 
     args = parser.parse_args()
-    args.config = yaml.load(args.config)
+    args.config = yaml.safe_load(args.config)
     Colors().set_colordict(args.config['colors'])
     return args
 
 def main(args):
+    instrument.start(args)
     window = init_window(args.config)
-    loop(window, args.config)
+    try:
+        loop(window, args.config)
+    finally:
+        instrument.finish(args)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
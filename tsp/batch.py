@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""Headless runner for the travelling salesman annealer.
+
+Runs SalesmanRoute without any display and prints the best tour found
+together with run statistics as JSON:
+
+    $ python batch.py -n 100000
+    $ python batch.py --time-limit 60 -o result.json
+    $ python batch.py -n 1000000 --instance berlin52.tsp
+    $ python batch.py -n 1000000 --block-size 256
+
+Runs stop at the first limit reached of the options or of the stop
+section of the config; --patience stops once the best tour hasn't
+improved for that many iterations:
+
+    $ python batch.py --patience 200000 -t 600
+
+With --checkpoint the state is saved every --checkpoint-every seconds
+and at the end; --resume continues from it, -n counts iterations of the
+whole run then:
+
+    $ python batch.py -n 10000000 --checkpoint run.npz --resume
+"""
+
+import os
+import json
+import time
+import yaml
+import argparse
+import logging
+
+from model import *
+
+import tsplib
+import instrument
+from schedules import StopRule
+import checkpoint
+
+
+def run(model, stop, check_every=256, checkpointer=None):
+    """(SalesmanRoute, StopRule, int, Checkpointer) -> dict
+
+    Update the model until the stop rule says so. It is asked and
+    checkpoints are made every check_every iterations.
+    """
+    if not stop:
+        raise ValueError('at least one stop condition is required')
+
+    initial_nrg = model.nrg
+    start_iteration = model.iteration
+    start_accepted = model.accepted
+    start = time.time()
+    stop.start(model)
+    while True:
+        reason = stop.reason(model)
+        if reason is not None:
+            break
+        model.update_many(stop.steps(model, check_every))
+        if checkpointer is not None:
+            checkpointer.maybe_save()
+    elapsed = time.time() - start
+    done = model.iteration - start_iteration
+
+    return {
+        'stop_reason': reason,
+        'iterations': done,
+        'tick': model.tick,
+        'temperature': model.temperature,
+        'schedule': model.type,
+        'time': elapsed,
+        'iterations_per_second': done / elapsed if elapsed > 0 else None,
+        'sampler': 'knn' if model.neighbours > 0 else 'uniform',
+        'acceptance_rate': ((model.accepted - start_accepted) / done
+                            if done else None),
+        'initial_energy': initial_nrg,
+        'energy': model.nrg,
+        'best_energy': model.best_nrg,
+        'last_improvement': model.last_improvement,
+    }
+
+
+def result(model, stats, instance=None):
+    """(SalesmanRoute, dict, tsplib.Instance) -> dict
+    """
+    output = {
+        'best_energy': model.best_nrg,
+        'best_tour': model.best_order.tolist(),
+        'towns': model.towns.tolist(),
+        'stats': stats,
+    }
+    if instance is not None:
+        output['instance'] = instance.report(model.best_order)
+    return output
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '-c', '--config',
+        default=os.path.join(os.path.dirname(__file__), 'config.yaml'),
+        type=argparse.FileType('rt'),
+        help='path to config')
+    parser.add_argument(
+        '-n', '--iterations', type=int,
+        help='number of iterations to run')
+    parser.add_argument(
+        '-t', '--time-limit', type=float,
+        help='wall clock limit in seconds')
+    parser.add_argument(
+        '--min-temperature', type=float,
+        help='stop when temperature falls to this value')
+    parser.add_argument(
+        '--patience', type=int,
+        help='stop after this many iterations without a better tour')
+    parser.add_argument(
+        '-o', '--output', default='-',
+        type=argparse.FileType('wt'),
+        help='where to write JSON result (stdout by default)')
+    parser.add_argument(
+        '--instance',
+        help='TSPLIB or CSV file of towns, overrides model.instance')
+    parser.add_argument(
+        '--block-size', type=int,
+        help='moves scored at once, overrides model.block_size')
+    parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument(
+        '--checkpoint',
+        help='path of the .npz checkpoint to save the state to')
+    parser.add_argument(
+        '--checkpoint-every', type=float, default=60.,
+        help='seconds between checkpoints')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='continue from the checkpoint if it exists')
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+    if args.resume and args.checkpoint is None:
+        parser.error('--resume needs --checkpoint')
+    args.config = yaml.safe_load(args.config)
+    if not StopRule.from_config(
+            args.config, iterations=args.iterations,
+            time_limit=args.time_limit, patience=args.patience,
+            min_temperature=args.min_temperature):
+        parser.error('one of --iterations, --time-limit, --patience or '
+                     '--min-temperature is required, or the stop section '
+                     'of the config')
+    if args.instance is not None:
+        args.config['model']['instance'] = args.instance
+    if args.block_size is not None:
+        args.config['model']['block_size'] = args.block_size
+    if args.seed is not None:
+        args.config['model']['seed'] = args.seed
+    return args
+
+
+def checkpoint_state(model):
+    """(SalesmanRoute) -> dict
+
+    State of the model together with its towns.
+    """
+    return dict(model.state(), towns=model.towns)
+
+
+def resume(config, path):
+    """(dict, str) -> SalesmanRoute
+    """
+    state = checkpoint.load(path)
+    model = SalesmanRoute(config, state['towns'])
+    model.load_state(state)
+    return model
+
+
+def main(args):
+    instrument.start(args)
+    stop = StopRule.from_config(
+        args.config, iterations=args.iterations, time_limit=args.time_limit,
+        patience=args.patience, min_temperature=args.min_temperature)
+    instance = None
+    if args.config['model'].get('instance'):
+        instance = tsplib.load(args.config['model']['instance'])
+    if args.resume and os.path.exists(args.checkpoint):
+        model = resume(args.config, args.checkpoint)
+        logging.info('Resumed from iteration %d', model.iteration)
+        if stop.iterations is not None:
+            stop.iterations = max(0, stop.iterations - model.iteration)
+    else:
+        model = SalesmanRoute(
+            args.config, None if instance is None else instance.towns)
+
+    checkpointer = None
+    if args.checkpoint is not None:
+        checkpointer = checkpoint.Checkpointer(
+            args.checkpoint, lambda: checkpoint_state(model),
+            args.checkpoint_every)
+    try:
+        stats = run(model, stop, checkpointer=checkpointer)
+    finally:
+        if checkpointer is not None:
+            checkpointer.close()
+        instrument.finish(args)
+    json.dump(result(model, stats, instance), args.output, indent=2)
+    args.output.write('\n')
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main(parse_args())
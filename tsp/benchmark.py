@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+"""Time-to-quality benchmark of annealer neighbourhood moves.
+
+Every move mix anneals the same random instance for the same wall clock
+budget. The table shows best energy reached and how long it took to get
+within --gap of the best energy found by any mix:
+
+    $ python benchmark.py -n 500 -t 10
+    $ python benchmark.py --instance berlin52.tsp -t 10
+
+Every mix runs with each sampler of --neighbours: 0 draws positions
+uniformly, K > 0 from the K nearest towns, and from each initial tour
+of --inits. Building the initial tour counts into the time to target.
+The suite compares them too:
+
+    $ python benchmark.py -n 5000 --inits random greedy hilbert
+
+With --suite the configured annealer runs on seeded random and
+clustered instances of several sizes instead. Cost of energy() and of
+one iteration, time to reach --target of the initial energy and
+time to get within --gap of the best energy of the instance are
+written as JSON, so runs on different commits can be compared:
+
+    $ python benchmark.py --suite -o before.json
+    $ python benchmark.py --suite --sizes 100 1000 -t 2 -o after.json
+"""
+
+import os
+import math
+import json
+import time
+import yaml
+import argparse
+import platform
+import subprocess
+import logging
+
+import numpy
+
+from model import *
+
+import tsplib
+
+
+MOVE_MIXES = [
+    ('swap', {'swap': 1}),
+    ('two_opt', {'two_opt': 1}),
+    ('or_opt', {'or_opt': 1}),
+    ('two_opt+or_opt', {'two_opt': 2, 'or_opt': 1}),
+    ('all', {'swap': 1, 'two_opt': 4, 'or_opt': 2}),
+]
+
+
+def anneal(config, towns, time_limit, check_every=1000):
+    """(dict, numpy.array, float, int) -> (SalesmanRoute, list)
+
+    Returns the model and a trace of (seconds, iterations, best energy)
+    which starts when the model, and so its initial tour, is built.
+    """
+    start = time.time()
+    model = SalesmanRoute(config, towns)
+    trace = [(time.time() - start, 0, model.best_nrg)]
+    while trace[-1][0] < time_limit:
+        model.update_many(check_every)
+        trace.append((time.time() - start, model.iteration, model.best_nrg))
+    return model, trace
+
+
+def time_to_target(trace, target):
+    for seconds, iterations, nrg in trace:
+        if nrg <= target:
+            return seconds, iterations
+    return None, None
+
+
+def random_towns(n, size, rng):
+    """(int, (float, float), Generator) -> (N, 2) numpy.array
+    """
+    return rng.random((n, 2)) * numpy.array(size)
+
+
+def clustered_towns(n, size, rng, clusters=None):
+    """(int, (float, float), Generator, int) -> (N, 2) numpy.array
+
+    Towns normally distributed around sqrt(N) random centers and
+    clipped to the window.
+    """
+    size = numpy.array(size, dtype=float)
+    if clusters is None:
+        clusters = max(1, int(math.sqrt(n)))
+    centers = rng.random((clusters, 2)) * size
+    spread = size.min() / (4 * math.sqrt(clusters))
+    towns = (centers[rng.integers(clusters, size=n)] +
+             rng.normal(scale=spread, size=(n, 2)))
+    return numpy.clip(towns, 0, size)
+
+
+INSTANCES = {
+    'random': random_towns,
+    'clustered': clustered_towns,
+}
+
+
+def environment():
+    """() -> dict
+
+    What the results depend on besides the code: versions and commit.
+    """
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def sampler(neighbours):
+    return 'knn{0}'.format(neighbours) if neighbours > 0 else 'uniform'
+
+
+def variants(config, neighbours, inits):
+    """(dict, [int], [str]) -> [(str, dict)]
+
+    Model configs for every sampler and initial tour, with their names
+    when there is more than one.
+    """
+    if inits is None:
+        inits = [config['model'].get('initial_tour', 'identity')]
+    result = []
+    for init in inits:
+        for k in neighbours:
+            names = ([sampler(k)] if len(neighbours) > 1 else []) + (
+                [init] if len(inits) > 1 else [])
+            result.append(('/'.join(names), dict(
+                config['model'], neighbours=k, initial_tour=init)))
+    return result
+
+
+def measure(config, kind, n, seed, iterations, time_limit, target,
+            neighbours=0, init=None):
+    """(dict, str, int, int, int, float, float, int, str) -> (dict, list)
+
+    Benchmark one instance. Iterations are timed on a fresh model, time
+    to target on another one, both seeded the same way. Returns the
+    results and the trace of the second model.
+    """
+    rng = numpy.random.default_rng(seed)
+    towns = INSTANCES[kind](n, config['window']['size'], rng)
+    if init is None:
+        init = config['model'].get('initial_tour', 'identity')
+    config = dict(config, model=dict(config['model'], seed=seed,
+                                     neighbours=neighbours,
+                                     initial_tour=init))
+
+    start = time.time()
+    model = SalesmanRoute(config, towns)
+    setup = time.time() - start
+    start = time.time()
+    model.candidates
+    knn_time = time.time() - start
+
+    repeats = max(1, 10**6 // n)
+    start = time.time()
+    for _ in range(repeats):
+        model.energy()
+    energy_time = (time.time() - start) / repeats
+
+    start = time.time()
+    model.update_many(iterations)
+    iteration_time = (time.time() - start) / iterations
+    acceptance_rate = float(model.accepted) / iterations
+
+    model, trace = anneal(config, towns, time_limit,
+                          check_every=min(1000, iterations))
+    seconds, target_iterations = time_to_target(
+        trace, target * trace[0][2])
+    return {
+        'kind': kind,
+        'towns': n,
+        'seed': seed,
+        'sampler': sampler(neighbours),
+        'initial_tour': init,
+        'setup_time': setup,
+        'knn_time': knn_time,
+        'energy_time': energy_time,
+        'iteration_time': iteration_time,
+        'proposals_per_second': 1. / iteration_time,
+        'acceptance_rate': acceptance_rate,
+        'initial_energy': trace[0][2],
+        'best_energy': model.best_nrg,
+        'iterations': model.iteration,
+        'target_energy': target * trace[0][2],
+        'target_time': seconds,
+        'target_iterations': target_iterations,
+    }, trace
+
+
+def suite(args):
+    inits = args.inits or [
+        args.config['model'].get('initial_tour', 'identity')]
+    results = []
+    for kind in args.kinds:
+        for n in args.sizes:
+            runs = []
+            for init in inits:
+                for neighbours in args.neighbours:
+                    logging.info('%s instance of %d towns, %s sampler, '
+                                 '%s initial tour',
+                                 kind, n, sampler(neighbours), init)
+                    runs.append(measure(
+                        args.config, kind, n, args.seed, args.iterations,
+                        args.time_limit, args.target, neighbours, init))
+            # Every run of the instance aims at the same energy.
+            gap_energy = (1 + args.gap) * min(
+                result['best_energy'] for result, _ in runs)
+            for result, trace in runs:
+                seconds, iterations = time_to_target(trace, gap_energy)
+                result.update(gap_energy=gap_energy, gap_time=seconds,
+                              gap_iterations=iterations)
+                results.append(result)
+    json.dump({
+        'benchmark': 'tsp',
+        'environment': environment(),
+        'config': args.config['model'],
+        'results': results,
+    }, args.output, indent=2)
+    args.output.write('\n')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '-c', '--config',
+        default=os.path.join(os.path.dirname(__file__), 'config.yaml'),
+        type=argparse.FileType('rt'),
+        help='path to config')
+    parser.add_argument(
+        '-n', '--num-towns', type=int, default=200,
+        help='instance size')
+    parser.add_argument(
+        '-t', '--time-limit', type=float, default=5.,
+        help='wall clock budget per move mix in seconds')
+    parser.add_argument(
+        '--gap', type=float, default=0.05,
+        help='target quality relative to the best found energy')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='random seed of the instance and the runs')
+    parser.add_argument(
+        '--instance',
+        help='TSPLIB or CSV file to compare move mixes on instead of '
+             'a random instance')
+    parser.add_argument(
+        '--suite', action='store_true',
+        help='run the instance suite and write JSON results')
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000],
+        help='instance sizes of the suite')
+    parser.add_argument(
+        '--kinds', nargs='+', choices=sorted(INSTANCES),
+        default=['random', 'clustered'],
+        help='instance kinds of the suite')
+    parser.add_argument(
+        '--iterations', type=int, default=20000,
+        help='iterations timed per suite instance')
+    parser.add_argument(
+        '--target', type=float, default=0.5,
+        help='suite target energy relative to the initial one')
+    parser.add_argument(
+        '--neighbours', type=int, nargs='+', default=[0, 10],
+        help='samplers to compare: 0 for uniform pairs, K for pairs of '
+             'K nearest towns')
+    parser.add_argument(
+        '--inits', nargs='+',
+        choices=['identity', 'random'] + sorted(INITIAL_TOURS),
+        help='initial tours to compare, model.initial_tour by default')
+    parser.add_argument(
+        '--block-size', type=int,
+        help='moves scored at once, overrides model.block_size')
+    parser.add_argument(
+        '-o', '--output', default='-',
+        type=argparse.FileType('wt'),
+        help='where to write suite results (stdout by default)')
+
+    args = parser.parse_args()
+    args.config = yaml.safe_load(args.config)
+    if args.block_size is not None:
+        args.config['model']['block_size'] = args.block_size
+    return args
+
+
+def main(args):
+    if args.suite:
+        return suite(args)
+
+    config = args.config
+    config['model']['seed'] = args.seed
+    instance = None
+    if args.instance is not None:
+        instance = tsplib.load(args.instance)
+        towns = instance.towns
+    else:
+        towns = random_towns(args.num_towns, config['window']['size'],
+                             numpy.random.default_rng(args.seed))
+
+    results = []
+    for mix, moves in MOVE_MIXES:
+        for variant, model_config in variants(config, args.neighbours,
+                                              args.inits):
+            model, trace = anneal(
+                dict(config, model=dict(model_config, moves=moves)),
+                towns, args.time_limit)
+            name = '/'.join([mix] + ([variant] if variant else []))
+            results.append((name, model, trace))
+
+    target = min(model.best_nrg for _, model, _ in results) * (1 + args.gap)
+    print('target energy: {0:.1f}'.format(target))
+    print('{0:<36}{1:>14}{2:>10}{3:>12}{4:>10}{5:>14}{6:>16}{7:>14}'.format(
+        'moves', 'start energy', 'setup, s', 'iterations', 'accepted',
+        'best energy', 'target time, s', 'target iters'))
+    for name, model, trace in results:
+        seconds, iterations = time_to_target(trace, target)
+        print('{0:<36}{1:>14.1f}{2:>10.3f}{3:>12}{4:>10.2%}{5:>14.1f}'
+              '{6:>16}{7:>14}'.format(
+                  name, trace[0][2], trace[0][0], model.iteration,
+                  float(model.accepted) / model.iteration, model.best_nrg,
+                  '-' if seconds is None else '{0:.2f}'.format(seconds),
+                  '-' if iterations is None else iterations))
+
+    if instance is not None and instance.optimal_tour is not None:
+        print('optimal tour length: {0}'.format(instance.optimal_length))
+        for name, model, trace in results:
+            print('{0:<36}{1:>12.2%}'.format(
+                name, instance.gap(model.best_order)))
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main(parse_args())
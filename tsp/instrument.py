@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""Opt-in timers and counters for the hot paths.
+
+Instrumented code asks profiler.enabled once and does nothing else
+while it is off:
+
+    >>> profiler.enable()
+    >>> start = profiler.clock()
+    >>> start = profiler.add_time('phase', start)
+    >>> profiler.count('moves.accepted')
+    >>> profiler.counters['moves.accepted'], profiler.timers['phase'][0]
+    (1, 1)
+    >>> profiler.disable(); profiler.reset()
+
+Timers keep number of calls, total and longest time. With trace on
+every timed phase is also kept as an event, up to max_events of them,
+and dump() writes them in the Chrome trace event format next to the
+totals.
+"""
+
+import sys
+import json
+import time
+import argparse
+
+
+class Profiler(object):
+    def __init__(self, max_events=100000):
+        self.enabled = False
+        self.trace = False
+        self.max_events = max_events
+        self.reset()
+
+    def enable(self, trace=False):
+        self.enabled = True
+        self.trace = trace
+
+    def disable(self):
+        self.enabled = False
+        self.trace = False
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+        self.events = []
+        self.dropped_events = 0
+        self._origin = time.perf_counter()
+
+    clock = staticmethod(time.perf_counter)
+
+    def add_time(self, name, start):
+        """(Profiler, str, float) -> float
+
+        Account the time since start (a clock() value) to the named
+        phase. Returns the current clock, the start of the next phase.
+        """
+        end = time.perf_counter()
+        spent = end - start
+        timer = self.timers.get(name)
+        if timer is None:
+            self.timers[name] = [1, spent, spent]
+        else:
+            timer[0] += 1
+            timer[1] += spent
+            if spent > timer[2]:
+                timer[2] = spent
+        if self.trace:
+            if len(self.events) < self.max_events:
+                self.events.append((name, start, spent))
+            else:
+                self.dropped_events += 1
+        return end
+
+    def count(self, name, number=1):
+        """(Profiler, str, int) -> NoneType
+        """
+        self.counters[name] = self.counters.get(name, 0) + number
+
+    def summary(self):
+        """(Profiler) -> str
+
+        Table of timers sorted by total time and of counters.
+        """
+        lines = ['{0:<28}{1:>12}{2:>12}{3:>12}{4:>12}'.format(
+            'phase', 'calls', 'total, s', 'mean, us', 'max, us')]
+        for name, (calls, total, longest) in sorted(
+                self.timers.items(), key=lambda item: -item[1][1]):
+            lines.append('{0:<28}{1:>12}{2:>12.3f}{3:>12.1f}{4:>12.1f}'.format(
+                name, calls, total, 1e6 * total / calls, 1e6 * longest))
+        if self.counters:
+            lines.append('')
+            lines.append('{0:<28}{1:>12}'.format('counter', 'value'))
+            for name, value in sorted(self.counters.items()):
+                lines.append('{0:<28}{1:>12}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        """(Profiler) -> dict
+        """
+        return {
+            'timers': {
+                name: {'calls': calls, 'total': total, 'max': longest}
+                for name, (calls, total, longest) in self.timers.items()},
+            'counters': dict(self.counters),
+            'dropped_events': self.dropped_events,
+            'traceEvents': [
+                {'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+                 'ts': 1e6 * (start - self._origin), 'dur': 1e6 * spent}
+                for name, start, spent in self.events],
+        }
+
+    def dump(self, stream):
+        """(Profiler, file) -> NoneType
+        """
+        json.dump(self.to_dict(), stream)
+        stream.write('\n')
+
+
+profiler = Profiler()
+
+
+def add_arguments(parser):
+    """(argparse.ArgumentParser) -> NoneType
+    """
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='print time spent in every phase to stderr on exit')
+    parser.add_argument(
+        '--trace', type=argparse.FileType('wt'),
+        help='write timers, counters and phase events as JSON')
+
+
+def start(args):
+    """(argparse.Namespace) -> NoneType
+
+    Turn the profiler on when the command line asks for it.
+    """
+    if args.profile or args.trace is not None:
+        profiler.enable(trace=args.trace is not None)
+
+
+def finish(args):
+    """(argparse.Namespace) -> NoneType
+    """
+    if args.profile:
+        sys.stderr.write(profiler.summary())
+    if args.trace is not None:
+        profiler.dump(args.trace)
+        args.trace.close()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,72 +1,929 @@
 import numpy
-import numpy.random as random
 import math
-import copy
 
 import logging
 
+from instrument import profiler
+
+import schedules
+
+
+MOVES = ('swap', 'two_opt', 'or_opt')
+
+
+def distance_matrix(towns):
+    """((N, 2) numpy.array) -> (N, N) numpy.array
+    """
+    diff = towns[:, numpy.newaxis, :] - towns[numpy.newaxis, :, :]
+    return numpy.hypot(diff[..., 0], diff[..., 1])
+
+
+def _expand(counts):
+    """(numpy.array) -> (numpy.array, numpy.array)
+
+    For every item repeated counts times return its index and the number
+    of the repetition.
+    """
+    owners = numpy.repeat(numpy.arange(len(counts)), counts)
+    steps = numpy.arange(counts.sum()) - numpy.repeat(
+        numpy.cumsum(counts) - counts, counts)
+    return owners, steps
+
+
+def _grid(towns, occupancy):
+    """((N, 2) numpy.array, float) -> tuple
+
+    Uniform grid of about occupancy towns per cell: cell side, grid
+    shape, cell of every town, towns sorted by cell key and where every
+    cell starts in that order and how many towns it has.
+
+    Clustered towns crowd into few cells of a grid sized by their
+    bounding box, the cells are made smaller then, up to 16 N cells.
+    """
+    n = len(towns)
+    low = towns.min(axis=0)
+    extent = numpy.maximum(towns.max(axis=0) - low, 1e-9)
+    side = max(math.sqrt(extent[0] * extent[1] * occupancy / n),
+               extent.max() / n)
+    for _ in range(4):
+        shape = numpy.minimum((extent // side).astype(int) + 1, n)
+        cells = numpy.minimum(((towns - low) // side).astype(int),
+                              shape - 1)
+        keys = cells[:, 1] * shape[0] + cells[:, 0]
+        count = numpy.bincount(keys, minlength=shape[0] * shape[1])
+        # Mean number of towns sharing a cell with a town.
+        crowd = float((count ** 2).sum()) / n
+        if crowd < 2 * occupancy or shape[0] * shape[1] * 2 > 16 * n:
+            break
+        side /= min(math.sqrt(crowd / occupancy),
+                    math.sqrt(16. * n / (shape[0] * shape[1])))
+
+    order = numpy.argsort(keys, kind='stable')
+    start = numpy.cumsum(count) - count
+    return side, shape, cells, order, start, count
+
+
+def nearest_neighbours(towns, k):
+    """((N, 2) numpy.array, int) -> (N, k) numpy.array
+
+    Indices of the k nearest towns of every town, nearest first.
+
+    Towns are bucketed into a uniform grid of about k / 2 towns per cell
+    and compared with towns of the block of cells around their own.
+    Towns whose k-th neighbour may lie beyond the block border are
+    searched again with a larger block, so no N x N matrix is built.
+    """
+    n = len(towns)
+    k = min(k, n - 1)
+    side, shape, cells, order, start, count = _grid(towns, max(k / 2., 2.))
+
+    result = numpy.empty((n, k), dtype=int)
+    pending = numpy.arange(n)
+    radius = 1
+    while len(pending):
+        x, y = cells[pending, 0], cells[pending, 1]
+        x0 = numpy.maximum(x - radius, 0)
+        x1 = numpy.minimum(x + radius, shape[0] - 1)
+        owners, candidates = [], []
+        # Every row of a block is a contiguous run of sorted keys.
+        for dy in range(-radius, radius + 1):
+            row = y + dy
+            inside = numpy.flatnonzero((row >= 0) & (row < shape[1]))
+            first = start[row[inside] * shape[0] + x0[inside]]
+            last = row[inside] * shape[0] + x1[inside]
+            owner, step = _expand(start[last] + count[last] - first)
+            owners.append(inside[owner])
+            candidates.append(order[first[owner] + step])
+        owners = numpy.concatenate(owners)
+        candidates = numpy.concatenate(candidates)
+        keep = candidates != pending[owners]
+        owners, candidates = owners[keep], candidates[keep]
+
+        diff = towns[pending[owners]] - towns[candidates]
+        distances = numpy.hypot(diff[:, 0], diff[:, 1])
+        # Owner plus distance scaled into [0, 0.5] sorts by both at once,
+        # much faster than lexsort.
+        scale = 0.5 / max(distances.max(initial=0.), 1e-12)
+        ranked = numpy.argsort(owners + distances * scale)
+        owners, candidates = owners[ranked], candidates[ranked]
+        distances = distances[ranked]
+
+        found = numpy.bincount(owners, minlength=len(pending))
+        begin = numpy.cumsum(found) - found
+        whole = ((x0 == 0) & (x1 == shape[0] - 1) &
+                 (y - radius <= 0) & (y + radius >= shape[1] - 1))
+        done = found >= k
+        done[done] &= (whole[done] | (
+            distances[begin[done] + k - 1] <= radius * side))
+        rows = begin[done][:, numpy.newaxis] + numpy.arange(k)
+        result[pending[done]] = candidates[rows]
+        pending = pending[~done]
+        radius *= 2
+    return result
+
+
+class _TownGrid(object):
+    """_TownGrid -- towns which can be removed one by one, with the
+    nearest remaining town of any town at hand.
+    """
+    def __init__(self, towns, alive):
+        self.towns = towns
+        self.alive = alive
+        (self.side, self.shape, self.cells, self.order, self.start,
+         self.count) = _grid(towns, 2.)
+        self.left = numpy.zeros(self.shape[::-1], dtype=int)
+        numpy.add.at(self.left, (self.cells[alive, 1], self.cells[alive, 0]),
+                     1)
+
+    def remove(self, town):
+        if self.alive[town]:
+            self.alive[town] = False
+            self.left[self.cells[town, 1], self.cells[town, 0]] -= 1
+
+    def _block(self, x, y, radius):
+        y0, x0 = max(y - radius, 0), max(x - radius, 0)
+        rows, columns = numpy.nonzero(
+            self.left[y0:y + radius + 1, x0:x + radius + 1])
+        towns = [self.order[self.start[key]:self.start[key] + self.count[key]]
+                 for key in ((rows + y0) * self.shape[0] + columns + x0)]
+        if not towns:
+            return towns
+        towns = numpy.concatenate(towns)
+        return towns[self.alive[towns]]
+
+    def nearest(self, town):
+        """(_TownGrid, int) -> int
+
+        Nearest remaining town, -1 when there are none.
+        """
+        x, y = self.cells[town]
+        radius, largest = 1, max(self.shape)
+        found = self._block(x, y, radius)
+        while not len(found) and radius < largest:
+            radius *= 2
+            found = self._block(x, y, radius)
+        if not len(found):
+            return -1
+        diff = self.towns[found] - self.towns[town]
+        distances = numpy.hypot(diff[:, 0], diff[:, 1])
+        # A nearer town may still be in a cell outside the block.
+        reach = int(distances.min() // self.side) + 1
+        if reach > radius:
+            found = self._block(x, y, reach)
+            diff = self.towns[found] - self.towns[town]
+            distances = numpy.hypot(diff[:, 0], diff[:, 1])
+        return int(found[distances.argmin()])
+
+
+def nearest_neighbour_tour(towns, k=8):
+    """((N, 2) numpy.array, int) -> (N,) numpy.array
+
+    Start from the first town and always go to the nearest unvisited
+    one. The k nearest towns are tried first, a grid of unvisited towns
+    is searched when all of them are visited.
+    """
+    n = len(towns)
+    candidates = nearest_neighbours(towns, k).tolist()
+    visited = numpy.zeros(n, dtype=bool)
+    grid = _TownGrid(towns, numpy.ones(n, dtype=bool))
+    tour = [0]
+    visited[0] = True
+    grid.remove(0)
+    town = 0
+    for _ in range(n - 1):
+        for near in candidates[town]:
+            if not visited[near]:
+                town = near
+                break
+        else:
+            town = grid.nearest(town)
+        visited[town] = True
+        grid.remove(town)
+        tour.append(town)
+    return numpy.array(tour)
+
+
+def greedy_tour(towns, k=10):
+    """((N, 2) numpy.array, int) -> (N,) numpy.array
+
+    Greedy edge matching: edges between towns and their k nearest
+    towns, shortest first, are added unless a town would get a third
+    edge or a cycle would close. The resulting fragments are joined
+    end to nearest end.
+    """
+    n = len(towns)
+    near = nearest_neighbours(towns, k)
+    first = numpy.repeat(numpy.arange(n), near.shape[1])
+    edges = numpy.sort(numpy.minimum(first, near.ravel()) * n +
+                       numpy.maximum(first, near.ravel()))
+    edges = edges[numpy.concatenate(([True], edges[1:] != edges[:-1]))]
+    first, second = edges // n, edges % n
+    diff = towns[first] - towns[second]
+    shortest = numpy.argsort(numpy.hypot(diff[:, 0], diff[:, 1]),
+                             kind='stable')
+
+    links = [[] for _ in range(n)]
+    fragment = list(range(n))
+
+    def find(town):
+        while fragment[town] != town:
+            fragment[town] = fragment[fragment[town]]
+            town = fragment[town]
+        return town
+
+    for a, b in zip(first[shortest].tolist(), second[shortest].tolist()):
+        if len(links[a]) < 2 and len(links[b]) < 2:
+            root_a, root_b = find(a), find(b)
+            if root_a != root_b:
+                fragment[root_a] = root_b
+                links[a].append(b)
+                links[b].append(a)
+
+    ends = numpy.array([len(town_links) < 2 for town_links in links])
+    grid = _TownGrid(towns, ends.copy())
+    tour = []
+    town = int(numpy.flatnonzero(ends)[0])
+    while town >= 0:
+        grid.remove(town)
+        previous = -1
+        while True:
+            tour.append(town)
+            following = [t for t in links[town] if t != previous]
+            if not following:
+                break
+            previous, town = town, following[0]
+        grid.remove(town)
+        town = grid.nearest(town)
+    return numpy.array(tour)
+
+
+def hilbert_tour(towns, bits=16):
+    """((N, 2) numpy.array, int) -> (N,) numpy.array
+
+    Towns in the order of the Hilbert curve through a 2**bits square
+    grid laid over them.
+    """
+    low = towns.min(axis=0)
+    extent = max((towns.max(axis=0) - low).max(), 1e-9)
+    size = 2 ** bits
+    x, y = numpy.minimum((towns - low) * (size / extent), size - 1).astype(
+        numpy.int64).T
+    index = numpy.zeros(len(towns), dtype=numpy.int64)
+    s = size // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        index += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so that the curve enters it the usual way.
+        flip = ~ry & rx
+        x = numpy.where(flip, size - 1 - x, x)
+        y = numpy.where(flip, size - 1 - y, y)
+        x, y = numpy.where(ry, x, y), numpy.where(ry, y, x)
+        s //= 2
+    return numpy.argsort(index, kind='stable')
+
+
+INITIAL_TOURS = {
+    'nearest_neighbour': nearest_neighbour_tour,
+    'greedy': greedy_tour,
+    'hilbert': hilbert_tour,
+}
+
 
 class SalesmanRoute(object):
-    def __init__(self, config):
-        self.num_towns = config['model']['num_towns']
-        self.t0 = config['model']['T0']
+    def __init__(self, config, towns=None):
         self.type = config['model']['type']
+        self.schedule = schedules.make(config['model'])
+        self.recompute_every = config['model'].get('recompute_every', 1000)
+        self.use_matrix = config['model'].get('distance_matrix', 'auto')
+        self.max_matrix_towns = config['model'].get('max_matrix_towns', 2000)
         self.window_size = numpy.array(config['window']['size'])
+        self.or_opt_length = config['model'].get('or_opt_length', 3)
+        self.neighbours = config['model'].get('neighbours', 0)
+        self.block_size = config['model'].get('block_size', 1)
+        self.initial_tour = config['model'].get('initial_tour', 'identity')
+        if self.initial_tour not in ('identity', 'random') + tuple(
+                INITIAL_TOURS):
+            raise ValueError(
+                'Unknown initial tour: {0}'.format(self.initial_tour))
+
+        moves = config['model'].get('moves', {'swap': 1})
+        for name in moves:
+            if name not in MOVES:
+                raise ValueError('Unknown move: {0}'.format(name))
+        self.moves = [name for name in MOVES if moves.get(name, 0) > 0]
+        weights = numpy.array([moves[name] for name in self.moves], float)
+        self._move_cdf = numpy.cumsum(weights / weights.sum()).tolist()
+
+        self.random = numpy.random.default_rng(config['model'].get('seed'))
+
+        if towns is None:
+            towns = (self.random.random((config['model']['num_towns'], 2)) *
+                     self.window_size)
+        # Towns never move, the route itself is a permutation of indices.
+        self.towns = numpy.ascontiguousarray(towns, dtype=float)
+        self.num_towns = len(self.towns)
 
         assert self.num_towns > 1
 
-        self.route = list(
-            random.random(2) * self.window_size
-            for _ in range(self.num_towns))
+        self.order = self.initial_order()
+        self._distances = None
+        self._candidates = None
+        self._position = None
 
         self.nrg = self.energy()
-        self.best = self.route
+        self.best_order = self.order.copy()
         self.best_nrg = self.nrg
 
         self.tick = 0
         self.iteration = 0
+        self.accepted = 0
+        self.last_improvement = 0
+
+    def initial_order(self):
+        """(SalesmanRoute) -> (N,) numpy.array
+
+        Route to start from: towns in the given order, shuffled or
+        built by one of INITIAL_TOURS.
+        """
+        if self.initial_tour == 'identity':
+            return numpy.arange(self.num_towns)
+        if self.initial_tour == 'random':
+            return self.random.permutation(self.num_towns)
+        return INITIAL_TOURS[self.initial_tour](self.towns)
+
+    def state(self):
+        """(SalesmanRoute) -> dict
+
+        Everything needed to continue the chain on another instance
+        built for the same towns, so that it goes on exactly as if it
+        was never stopped:
+
+        >>> import os, tempfile, checkpoint
+        >>> path = os.path.join(tempfile.mkdtemp(), 'run.npz')
+        >>> config = {'window': {'size': [600, 400]},
+        ...           'model': {'num_towns': 50, 'T0': 1000, 'seed': 0,
+        ...                     'type': 'adaptive', 'block_size': 16,
+        ...                     'moves': {'swap': 1, 'two_opt': 1}}}
+        >>> expected = SalesmanRoute(config)
+        >>> expected.update_many(6400)
+        >>> route = SalesmanRoute(config)
+        >>> route.update_many(3200)
+        >>> checkpoint.save(path, route.state())
+        >>> resumed = SalesmanRoute(config, route.towns)
+        >>> resumed.load_state(checkpoint.load(path))
+        >>> resumed.update_many(3200)
+        >>> bool((resumed.order == expected.order).all())
+        True
+        >>> resumed.best_nrg == expected.best_nrg
+        True
+        """
+        return {
+            'order': self.order.copy(),
+            'nrg': self.nrg,
+            'best_order': self.best_order.copy(),
+            'best_nrg': self.best_nrg,
+            'tick': self.tick,
+            'iteration': self.iteration,
+            'accepted': self.accepted,
+            'last_improvement': self.last_improvement,
+            'schedule': self.schedule.state(),
+            'random': self.random.bit_generator.state,
+        }
+
+    def load_state(self, state):
+        """(SalesmanRoute, dict) -> NoneType
+        """
+        self.order = numpy.array(state['order'])
+        self.nrg = state['nrg']
+        self.best_order = numpy.array(state['best_order'])
+        self.best_nrg = state['best_nrg']
+        self.tick = state['tick']
+        self.iteration = state['iteration']
+        self.accepted = state.get('accepted', 0)
+        self.last_improvement = state.get('last_improvement', self.iteration)
+        if state.get('schedule'):
+            self.schedule.load_state(state['schedule'])
+        self.random.bit_generator.state = state['random']
+        self._position = None
+
+    @property
+    def t0(self):
+        return self.schedule.t0
+
+    @t0.setter
+    def t0(self, t0):
+        self.schedule.t0 = float(t0)
+
+    @property
+    def temperature(self):
+        """Temperature at the current tick.
+        """
+        return self.schedule.temperature(max(self.tick, 1))
+
+    @property
+    def route(self):
+        return self.towns[self.order]
+
+    @property
+    def best(self):
+        return self.towns[self.best_order]
+
+    @property
+    def distances(self):
+        """Pairwise distance matrix, built on first use.
+
+        None when the matrix is disabled or the instance is too large
+        for it, distances are computed from coordinates then.
+        """
+        if self._distances is None:
+            if self.use_matrix == 'auto':
+                enabled = self.num_towns <= self.max_matrix_towns
+            else:
+                enabled = bool(self.use_matrix)
+            if not enabled:
+                return None
+            self._distances = distance_matrix(self.towns)
+        return self._distances
+
+    @property
+    def candidates(self):
+        """Nearest neighbours of every town, built on first use.
+
+        None when moves are drawn uniformly.
+        """
+        if self._candidates is None and self.neighbours > 0:
+            self._candidates = nearest_neighbours(self.towns, self.neighbours)
+        return self._candidates
+
+    @property
+    def position(self):
+        """Position of every town on the route, inverse of order.
+
+        Kept up to date by apply() once built.
+        """
+        if self._position is None:
+            self._position = numpy.empty_like(self.order)
+            self._position[self.order] = numpy.arange(self.num_towns)
+        return self._position
 
     def energy(self):
-        nrg = math.hypot(*(self.route[0] - self.route[-1]))
-        for x in range(len(self.route) - 1):
-            nrg += math.hypot(*(self.route[x] - self.route[x + 1]))
+        if profiler.enabled:
+            profiler.count('energy.calls')
+        points = self.route
+        diff = points - numpy.roll(points, 1, axis=0)
+        return float(numpy.hypot(diff[:, 0], diff[:, 1]).sum())
+
+    def _distance(self, i0, i1):
+        """Distance between towns on positions i0 and i1 of the route.
+        """
+        a, b = self.order.item(i0), self.order.item(i1)
+        if self.distances is not None:
+            return self._distances.item(a, b)
+        return math.hypot(self.towns.item(a, 0) - self.towns.item(b, 0),
+                          self.towns.item(a, 1) - self.towns.item(b, 1))
+
+    def swap_delta(self, i0, i1):
+        """(SalesmanRoute, int, int) -> float
+
+        Energy change caused by swapping towns on positions i0 and i1.
+        Only the (at most four) edges adjacent to these positions are
+        measured, so it takes O(1) instead of O(N) for energy().
+        """
+        if i0 == i1:
+            return 0.
+
+        n = self.num_towns
+        edges = set()
+        for i in (i0, i1):
+            edges.add((min((i - 1) % n, i), max((i - 1) % n, i)))
+            edges.add((min(i, (i + 1) % n), max(i, (i + 1) % n)))
+
+        swapped = {i0: i1, i1: i0}
+        delta = 0.
+        for a, b in edges:
+            delta -= self._distance(a, b)
+            delta += self._distance(swapped.get(a, a), swapped.get(b, b))
+        return delta
+
+    def two_opt_delta(self, i0, i1):
+        """(SalesmanRoute, int, int) -> float
+
+        Energy change of reversing the route segment between positions
+        i0 and i1 (inclusive). Only two edges are replaced.
+        """
+        i0, i1 = min(i0, i1), max(i0, i1)
+        n = self.num_towns
+        if i0 == 0 and i1 == n - 1:
+            return 0.
+        prev, next = (i0 - 1) % n, (i1 + 1) % n
+        return (self._distance(prev, i1) + self._distance(i0, next) -
+                self._distance(prev, i0) - self._distance(i1, next))
+
+    def or_opt_delta(self, i, length, p):
+        """(SalesmanRoute, int, int, int) -> float
+
+        Energy change of moving the segment of given length starting at
+        position i between positions p and p + 1. Edge (p, p + 1) must
+        not touch the segment.
+        """
+        n = self.num_towns
+        last = i + length - 1
+        prev, next = (i - 1) % n, (last + 1) % n
+        return (self._distance(prev, next) -
+                self._distance(prev, i) - self._distance(last, next) -
+                self._distance(p, (p + 1) % n) +
+                self._distance(p, i) + self._distance(last, (p + 1) % n))
+
+    def _near_position(self, i):
+        """Position of a random near neighbour of the town on position i.
+        """
+        candidates = self._candidates
+        town = candidates.item(
+            self.order.item(i), self.random.integers(candidates.shape[1]))
+        return self.position.item(town)
+
+    def propose(self):
+        """(SalesmanRoute) -> (float, tuple)
+
+        Choose a random move of one of the configured kinds, return
+        its energy change and the move itself for apply().
+
+        With neighbours set every move joins a random town with one of
+        its nearest towns instead of pairing uniformly random positions,
+        most of which are far apart on large instances.
+        """
+        kind = self.moves[0]
+        if len(self.moves) > 1:
+            x = self.random.random()
+            for name, bound in zip(self.moves, self._move_cdf):
+                kind = name
+                if x < bound:
+                    break
+
+        n = self.num_towns
+        if self.candidates is not None:
+            return self._propose_near(kind)
+        if kind == 'or_opt' and n > 3:
+            length = self.random.integers(
+                1, min(self.or_opt_length, n - 3) + 1)
+            i = self.random.integers(n - length + 1)
+            # Any edge not adjacent to the segment.
+            p = (i + length + self.random.integers(n - length - 1)) % n
+            return self.or_opt_delta(i, length, p), ('or_opt', i, length, p)
+
+        i0, i1 = self.random.integers(n, size=2)
+        if kind == 'two_opt':
+            i0, i1 = min(i0, i1), max(i0, i1)
+            return self.two_opt_delta(i0, i1), ('two_opt', i0, i1)
+        return self.swap_delta(i0, i1), ('swap', i0, i1)
 
-        return nrg
+    def _propose_near(self, kind):
+        n = self.num_towns
+        if kind == 'or_opt' and n > 3:
+            length = self.random.integers(
+                1, min(self.or_opt_length, n - 3) + 1)
+            i = self.random.integers(n - length + 1)
+            # Put the segment right after a neighbour of its first town.
+            p = self._near_position(i)
+            if (p - i + 1) % n <= length:
+                return 0., ('swap', i, i)
+            return self.or_opt_delta(i, length, p), ('or_opt', i, length, p)
+
+        i = self.random.integers(n)
+        j = self._near_position(i)
+        if kind == 'two_opt':
+            # Reversal which makes the two towns adjacent.
+            i0, i1 = min(i, j) + 1, max(i, j)
+            return self.two_opt_delta(i0, i1), ('two_opt', i0, i1)
+        i0 = (i + 1) % n
+        return self.swap_delta(i0, j), ('swap', i0, j)
+
+    def _gaps(self, i0, i1):
+        """Distances between towns on arrays of positions i0 and i1.
+        """
+        a, b = self.order[i0], self.order[i1]
+        if self.distances is not None:
+            return self._distances[a, b]
+        diff = self.towns[a] - self.towns[b]
+        return numpy.hypot(diff[:, 0], diff[:, 1])
+
+    def _swap_deltas(self, i0, i1):
+        n = self.num_towns
+        starts = (i0 - 1) % n, i0, (i1 - 1) % n, i1
+        edges = [(a, (a + 1) % n) for a in starts]
+        keys = [numpy.minimum(a, b) * n + numpy.maximum(a, b)
+                for a, b in edges]
+        deltas = numpy.zeros(len(i0))
+        for k, (a, b) in enumerate(edges):
+            # Adjacent positions share an edge, count it once.
+            first = numpy.ones(len(i0), dtype=bool)
+            for key in keys[:k]:
+                first &= keys[k] != key
+            a1 = numpy.where(a == i0, i1, numpy.where(a == i1, i0, a))
+            b1 = numpy.where(b == i0, i1, numpy.where(b == i1, i0, b))
+            deltas += first * (self._gaps(a1, b1) - self._gaps(a, b))
+        return deltas
+
+    def _two_opt_deltas(self, i0, i1):
+        n = self.num_towns
+        prev, next = (i0 - 1) % n, (i1 + 1) % n
+        deltas = (self._gaps(prev, i1) + self._gaps(i0, next) -
+                  self._gaps(prev, i0) - self._gaps(i1, next))
+        deltas[(i0 == 0) & (i1 == n - 1)] = 0.
+        return deltas
+
+    def _or_opt_deltas(self, i, length, p):
+        n = self.num_towns
+        last = i + length - 1
+        prev, next = (i - 1) % n, (last + 1) % n
+        return (self._gaps(prev, next) -
+                self._gaps(prev, i) - self._gaps(last, next) -
+                self._gaps(p, (p + 1) % n) +
+                self._gaps(p, i) + self._gaps(last, (p + 1) % n))
+
+    def propose_many(self, size):
+        """(SalesmanRoute, int) -> ((size,) numpy.array, (size, 3)
+                                      numpy.array, (size,) numpy.array)
+
+        Draw size moves like propose() does and score all of them
+        against the current route at once. Returns indices of move
+        kinds in MOVES, move arguments as apply() takes them (length
+        and p of or_opt in the last two columns) and energy changes.
+        """
+        n = self.num_towns
+        random = self.random
+        codes = numpy.array([MOVES.index(name) for name in self.moves])
+        kinds = codes[0]
+        if len(self.moves) > 1:
+            kinds = codes[numpy.minimum(
+                numpy.searchsorted(self._move_cdf, random.random(size),
+                                   side='right'), len(codes) - 1)]
+        kinds = numpy.broadcast_to(kinds, (size,)).copy()
+        if n <= 3:
+            kinds[kinds == MOVES.index('or_opt')] = MOVES.index('swap')
+        args = numpy.zeros((size, 3), dtype=int)
+        deltas = numpy.zeros(size)
+        candidates = self.candidates
+
+        pairs = numpy.flatnonzero(kinds != MOVES.index('or_opt'))
+        rows = numpy.flatnonzero(kinds == MOVES.index('or_opt'))
+        if len(rows):
+            length = random.integers(
+                1, min(self.or_opt_length, n - 3) + 1, size=len(rows))
+            i = random.integers(n - length + 1)
+            if candidates is None:
+                p = (i + length + random.integers(n - length - 1)) % n
+            else:
+                p = self.position[candidates[
+                    self.order[i],
+                    random.integers(candidates.shape[1], size=len(rows))]]
+                # Segments next to the neighbour already stay in place.
+                touching = (p - i + 1) % n <= length
+                kinds[rows[touching]] = MOVES.index('swap')
+                length[touching], p[touching] = i[touching], 0
+            args[rows] = numpy.stack((i, length, p), axis=1)
+            moving = rows[kinds[rows] == MOVES.index('or_opt')]
+            deltas[moving] = self._or_opt_deltas(*args[moving].T)
+
+        if len(pairs):
+            if candidates is None:
+                i0, i1 = random.integers(n, size=(2, len(pairs)))
+            else:
+                i = random.integers(n, size=len(pairs))
+                j = self.position[candidates[
+                    self.order[i],
+                    random.integers(candidates.shape[1], size=len(pairs))]]
+                two_opt = kinds[pairs] == MOVES.index('two_opt')
+                i0 = numpy.where(two_opt, numpy.minimum(i, j) + 1,
+                                 (i + 1) % n)
+                i1 = numpy.where(two_opt, numpy.maximum(i, j), j)
+            args[pairs, 0], args[pairs, 1] = i0, i1
+            two_opt = pairs[kinds[pairs] == MOVES.index('two_opt')]
+            args[two_opt, :2] = numpy.sort(args[two_opt, :2], axis=1)
+            deltas[two_opt] = self._two_opt_deltas(*args[two_opt, :2].T)
+            swap = pairs[kinds[pairs] == MOVES.index('swap')]
+            deltas[swap] = self._swap_deltas(*args[swap, :2].T)
+        return kinds, args, deltas
+
+    def apply(self, move):
+        """(SalesmanRoute, tuple) -> NoneType
+        """
+        order = self.order
+        kind = move[0]
+        if kind == 'swap':
+            _, i0, i1 = move
+            order[i0], order[i1] = order[i1], order[i0]
+            low, high = min(i0, i1), max(i0, i1) + 1
+        elif kind == 'two_opt':
+            _, i0, i1 = move
+            order[i0:i1 + 1] = order[i0:i1 + 1][::-1]
+            low, high = i0, i1 + 1
+        elif kind == 'or_opt':
+            _, i, length, p = move
+            low, high = min(i, p + 1), max(i + length, p + 1)
+            segment = order[i:i + length].copy()
+            rest = numpy.concatenate((order[:i], order[i + length:]))
+            if p > i:
+                p -= length
+            self.order = numpy.concatenate(
+                (rest[:p + 1], segment, rest[p + 1:]))
+        if self._position is not None:
+            self._position[self.order[low:high]] = numpy.arange(low, high)
 
     def tempreture(self, tick):
-        if self.type == 'fast':
-            return float(self.t0) / tick
-        return float(self.t0) / math.log(1 + self.tick)
+        return self.schedule.temperature(tick)
 
     def update(self):
+        """(SalesmanRoute) -> NoneType
+
+        One annealing step: propose a move and accept it or not. The
+        energy is kept up to date from the deltas of accepted moves and
+        stays that of the route for every kind of move:
+
+        >>> for name in MOVES:
+        ...     config = {'window': {'size': [600, 400]},
+        ...               'model': {'num_towns': 50, 'T0': 1000,
+        ...                         'type': 'fast', 'moves': {name: 1},
+        ...                         'seed': 0, 'recompute_every': 0}}
+        ...     route = SalesmanRoute(config)
+        ...     for _ in range(5000):
+        ...         route.update()
+        ...     print(name, abs(route.nrg - route.energy()) < 1e-6)
+        swap True
+        two_opt True
+        or_opt True
+        """
+        profiling = profiler.enabled
+        if profiling:
+            clock = profiler.clock()
+        # Messages are only formatted when somebody is going to see them.
+        debug = logging.root.isEnabledFor(logging.DEBUG)
+
         self.tick += 1
         self.iteration += 1
-        T = self.tempreture(self.tick)
-        logging.debug('-'*10 + ' iteration: {0} '.format(self.iteration) + '-'*10)
-        logging.debug('TEMPRETURE({0}) = {1}'.format(self.tick, T))
+        T = self.schedule.temperature(self.tick)
+        if debug:
+            logging.debug('%s iteration: %d %s', '-'*10, self.iteration,
+                          '-'*10)
+            logging.debug('TEMPRETURE(%d) = %s', self.tick, T)
 
-        i0, i1 = random.randint(len(self.route), size=2)
-
-        self.route[i0], self.route[i1] = self.route[i1], self.route[i0]
-        new_nrg = self.energy()
-        logging.debug('NEW ENERGY = {0}'.format(new_nrg))
-        logging.debug('ENERGY = {0}'.format(self.nrg))
-        logging.debug('BEST ENERGY = {0}'.format(self.best_nrg))
+        delta, move = self.propose()
+        new_nrg = self.nrg + delta
+        if profiling:
+            clock = profiler.add_time('update.propose', clock)
+            profiler.count('moves.proposed')
+        if debug:
+            logging.debug('NEW ENERGY = %s', new_nrg)
+            logging.debug('ENERGY = %s', self.nrg)
+            logging.debug('BEST ENERGY = %s', self.best_nrg)
 
+        accepted = improved = False
         if self.nrg > new_nrg:
+            self.apply(move)
             if self.best_nrg > new_nrg:
-                self.best = copy.deepcopy(self.route)
+                self.best_order = self.order.copy()
                 self.best_nrg = new_nrg
+                self.last_improvement = self.iteration
+                improved = True
             self.nrg = new_nrg
+            self.accepted += 1
+            accepted = True
+            if profiling:
+                profiler.count('moves.accepted')
         else:
             try:
                 prob = math.exp(- (new_nrg - self.nrg) / T)
-            except OverflowError:
+            except (OverflowError, ZeroDivisionError):
                 prob = 0
-            logging.debug("MUTATION PROBABILITY = {0}".format(prob))
-            if random.random() < prob:
-                logging.debug("RANDOM MUTATION ACCURED")
+            if debug:
+                logging.debug('MUTATION PROBABILITY = %s', prob)
+            if self.random.random() < prob:
+                if debug:
+                    logging.debug('RANDOM MUTATION ACCURED')
+                self.apply(move)
                 self.nrg = new_nrg
+                self.accepted += 1
+                accepted = True
+                if profiling:
+                    profiler.count('moves.accepted')
+                    profiler.count('moves.uphill')
+        if self.schedule.feedback:
+            uphill = delta > 0
+            self.schedule.observe(1, int(uphill), int(accepted and uphill),
+                                  improved)
+        if profiling:
+            clock = profiler.add_time('update.accept', clock)
+
+        if (self.recompute_every and
+                self.iteration % self.recompute_every == 0):
+            # Bound floating point drift of the accumulated deltas.
+            self.nrg = self.energy()
+            if profiling:
+                profiler.add_time('update.recompute', clock)
+
+    def _reserve(self, busy, kind, move):
+        """Mark positions whose edges the move reads or changes as busy,
+        unless some of them already are. Returns whether it succeeded.
+        """
+        n = self.num_towns
+        if kind == 'swap':
+            ranges = [(move[0] - 1, move[0] + 1), (move[1] - 1, move[1] + 1)]
+        elif kind == 'two_opt':
+            ranges = [(move[0] - 1, move[1] + 1)]
+        else:
+            i, length, p = move
+            ranges = [(min(i, p + 1) - 1, max(i + length, p + 1))]
+        spans = []
+        for low, high in ranges:
+            if high - low + 1 >= n:
+                spans.append((0, n))
+            elif low < 0:
+                spans.extend(((0, high + 1), (low + n, n)))
+            elif high >= n:
+                spans.extend(((low, n), (0, high - n + 1)))
             else:
-                self.tick -= 1
-                self.route[i0], self.route[i1] = self.route[i1], self.route[i0]
+                spans.append((low, high + 1))
+        for start, stop in spans:
+            if busy[start:stop].any():
+                return False
+        for start, stop in spans:
+            busy[start:stop] = True
+        return True
+
+    def update_many(self, iterations):
+        """(SalesmanRoute, int) -> NoneType
+
+        Run iterations in blocks of block_size moves. The moves of a
+        block are drawn and scored at once at the temperature of its
+        start, then the accepted ones which don't touch edges of each
+        other are applied in the order of drawing; the rest count as
+        rejected. The best route is checked once per block. With
+        block_size 1 it is the same as calling update() iterations times.
+        """
+        if self.block_size <= 1:
+            for _ in range(iterations):
+                self.update()
+            return
+        while iterations > 0:
+            size = min(self.block_size, iterations)
+            self._update_block(size)
+            iterations -= size
+
+    def _update_block(self, size):
+        profiling = profiler.enabled
+        if profiling:
+            clock = profiler.clock()
+
+        T = self.schedule.temperature(self.tick + 1)
+        kinds, args, deltas = self.propose_many(size)
+        if profiling:
+            clock = profiler.add_time('update.propose', clock)
+            profiler.count('moves.proposed', size)
+
+        with numpy.errstate(over='ignore', divide='ignore', invalid='ignore'):
+            prob = numpy.exp(-numpy.maximum(deltas, 0.) / T)
+        chosen = numpy.flatnonzero(self.random.random(size) < prob)
+        busy = numpy.zeros(self.num_towns, dtype=bool)
+        applied = 0
+        for row in chosen.tolist():
+            kind = MOVES[kinds[row]]
+            move = tuple(args[row].tolist()[:3 if kind == 'or_opt' else 2])
+            if kind == 'swap' and move[0] == move[1]:
+                applied += 1
+                continue
+            if not self._reserve(busy, kind, move):
+                continue
+            self.apply((kind,) + move)
+            self.nrg += deltas.item(row)
+            applied += 1
+            if profiling and deltas.item(row) > 0:
+                profiler.count('moves.uphill')
+        self.tick += size
+        self.accepted += applied
+        self.iteration += size
+        improved = self.best_nrg > self.nrg
+        if improved:
+            self.best_order = self.order.copy()
+            self.best_nrg = self.nrg
+            self.last_improvement = self.iteration
+        if self.schedule.feedback:
+            # Moves lost to conflicts say nothing about the temperature.
+            uphill = deltas > 0
+            self.schedule.observe(size, int(uphill.sum()),
+                                  int(uphill[chosen].sum()), improved)
+        if profiling:
+            clock = profiler.add_time('update.accept', clock)
+            profiler.count('moves.accepted', applied)
+            profiler.count('moves.conflicts', len(chosen) - applied)
+
+        if self.recompute_every and (
+                self.iteration // self.recompute_every !=
+                (self.iteration - size) // self.recompute_every):
+            self.nrg = self.energy()
+            if profiling:
+                profiler.add_time('update.recompute', clock)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""Several annealing chains on one instance in a process pool.
+
+Chains run for model iterations in rounds. Between rounds the
+coordinator either lets every chain continue from the best tour found
+so far (independent mode with share_best) or exchanges tours between
+neighbouring temperatures (tempering mode). Every chain has its own
+seeded generator which travels with its state, so the result depends
+only on the seed and not on the number of workers:
+
+    $ python multichain.py --chains 8 --rounds 50 --seed 1
+"""
+
+import os
+import math
+import json
+import time
+import yaml
+import argparse
+import logging
+import multiprocessing
+
+import numpy
+
+from model import *
+
+import tsplib
+
+
+_chain_model = None
+
+
+def _init_worker(config, towns):
+    global _chain_model
+    _chain_model = SalesmanRoute(config, towns)
+
+
+def _run_chain(task):
+    """((dict, float, int)) -> dict
+
+    Continue one chain from its state with the given T0.
+    """
+    state, t0, iterations = task
+    _chain_model.load_state(state)
+    _chain_model.t0 = t0
+    _chain_model.update_many(iterations)
+    state = _chain_model.state()
+    state['temperature'] = _chain_model.temperature
+    return state
+
+
+def _follow_coldest(states, t0_ratio):
+    """Put replicas of a schedule with feedback on the ladder above the
+    coldest one, they keep these temperatures for a round.
+    """
+    coldest = states[0]['schedule']['current']
+    for k, state in enumerate(states[1:], 1):
+        state['schedule'].update(current=coldest * t0_ratio ** k,
+                                 adapting=False)
+
+
+def run_chains(config, towns=None, chains=4, rounds=10, iterations=10000,
+               mode='independent', share_best=True, t0_ratio=2.,
+               workers=None, seed=None):
+    """(dict, numpy.array, ...) -> (SalesmanRoute, dict)
+
+    Run the chains and return a model holding the global best tour
+    together with run statistics.
+
+    mode is 'independent' or 'tempering'. In tempering mode chain k
+    anneals with T0 * t0_ratio ** k and neighbouring chains swap their
+    current tours with the replica exchange acceptance rule.
+
+    A schedule with feedback would steer every replica to the same
+    acceptance rate and so to about the same temperature. Only the
+    coldest chain adapts then, chain k runs every round at t0_ratio ** k
+    times its temperature. Either way the replicas stay apart:
+
+    >>> config = {'window': {'size': [600, 400]},
+    ...           'model': {'num_towns': 60, 'T0': 1000, 'type': 'adaptive'}}
+    >>> model, stats = run_chains(config, chains=4, rounds=3,
+    ...                           iterations=3000, mode='tempering',
+    ...                           workers=1, seed=0)
+    >>> temperatures = stats['temperatures']
+    >>> temperatures == sorted(set(temperatures))
+    True
+    >>> [round(high / low, 6) for low, high in zip(temperatures[1:],
+    ...                                            temperatures[2:])]
+    [2.0, 2.0]
+    """
+    if mode not in ('independent', 'tempering'):
+        raise ValueError('Unknown multichain mode: {0}'.format(mode))
+
+    seeds = numpy.random.SeedSequence(seed).spawn(chains + 2)
+    exchange_random = numpy.random.default_rng(seeds[0])
+
+    config = dict(config, model=dict(config['model'], seed=seeds[1]))
+    best = SalesmanRoute(config, towns)
+    towns = best.towns
+
+    states = []
+    for chain_seed in seeds[2:]:
+        chain = SalesmanRoute(
+            dict(config, model=dict(config['model'], seed=chain_seed)),
+            towns)
+        states.append(chain.state())
+    follow = mode == 'tempering' and best.schedule.feedback
+    t0s = [best.t0 * (t0_ratio ** k if mode == 'tempering' and not follow
+                      else 1)
+           for k in range(chains)]
+
+    pool = None
+    if workers == 1:
+        _init_worker(config, towns)
+    else:
+        pool = multiprocessing.Pool(
+            workers, initializer=_init_worker, initargs=(config, towns))
+
+    def run(tasks):
+        if pool is None:
+            return [_run_chain(task) for task in tasks]
+        return pool.map(_run_chain, tasks)
+
+    exchanges = [0, 0]
+    start = time.time()
+    try:
+        for _ in range(rounds):
+            if follow:
+                _follow_coldest(states, t0_ratio)
+            states = run([(state, t0, iterations)
+                          for state, t0 in zip(states, t0s)])
+
+            leader = min(states, key=lambda state: state['best_nrg'])
+            if leader['best_nrg'] < best.best_nrg:
+                best.best_order = leader['best_order'].copy()
+                best.best_nrg = leader['best_nrg']
+
+            if mode == 'tempering':
+                for k in range(chains - 1):
+                    a, b = states[k], states[k + 1]
+                    beta_a = 1. / a['temperature']
+                    beta_b = 1. / b['temperature']
+                    exponent = (beta_a - beta_b) * (a['nrg'] - b['nrg'])
+                    exchanges[1] += 1
+                    if (exponent >= 0 or
+                            exchange_random.random() < math.exp(exponent)):
+                        exchanges[0] += 1
+                        for key in ('order', 'nrg'):
+                            a[key], b[key] = b[key], a[key]
+            elif share_best:
+                for state in states:
+                    state['order'] = best.best_order.copy()
+                    state['nrg'] = best.best_nrg
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    best.order = best.best_order.copy()
+    best.nrg = best.best_nrg
+    best.iteration = sum(state['iteration'] for state in states)
+    stats = {
+        'mode': mode,
+        'chains': chains,
+        'rounds': rounds,
+        'iterations': best.iteration,
+        'time': time.time() - start,
+        'chain_best_energy': [state['best_nrg'] for state in states],
+        'best_energy': best.best_nrg,
+    }
+    if mode == 'tempering':
+        stats['exchanges_accepted'], stats['exchanges_proposed'] = exchanges
+        stats['temperatures'] = [state['temperature'] for state in states]
+    return best, stats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '-c', '--config',
+        default=os.path.join(os.path.dirname(__file__), 'config.yaml'),
+        type=argparse.FileType('rt'),
+        help='path to config')
+    parser.add_argument('--chains', type=int, help='number of chains')
+    parser.add_argument('--rounds', type=int, help='number of rounds')
+    parser.add_argument(
+        '-n', '--iterations', type=int,
+        help='iterations of every chain per round')
+    parser.add_argument(
+        '--mode', choices=('independent', 'tempering'),
+        help='independent chains or parallel tempering')
+    parser.add_argument(
+        '-j', '--workers', type=int,
+        help='number of worker processes (all cores by default)')
+    parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument(
+        '--instance',
+        help='TSPLIB or CSV file of towns, overrides model.instance')
+    parser.add_argument(
+        '-o', '--output', default='-',
+        type=argparse.FileType('wt'),
+        help='where to write JSON result (stdout by default)')
+
+    args = parser.parse_args()
+    args.config = yaml.safe_load(args.config)
+    if args.instance is not None:
+        args.config['model']['instance'] = args.instance
+    return args
+
+
+def main(args):
+    options = dict(args.config.get('multichain', {}))
+    for name in ('chains', 'rounds', 'iterations', 'mode', 'workers', 'seed'):
+        if getattr(args, name) is not None:
+            options[name] = getattr(args, name)
+    if 'seed' not in options:
+        options['seed'] = args.config['model'].get('seed')
+
+    instance = None
+    if args.config['model'].get('instance'):
+        instance = tsplib.load(args.config['model']['instance'])
+        options['towns'] = instance.towns
+
+    model, stats = run_chains(args.config, **options)
+    output = {
+        'best_energy': model.best_nrg,
+        'best_tour': model.best_order.tolist(),
+        'towns': model.towns.tolist(),
+        'stats': stats,
+    }
+    if instance is not None:
+        output['instance'] = instance.report(model.best_order)
+    json.dump(output, args.output, indent=2)
+    args.output.write('\n')
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main(parse_args())
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""Cooling schedules and stopping rules of the annealer.
+
+A schedule gives the temperature for a tick, the number of iterations
+of the chain so far. model.type names it, the section of the same name
+in model.schedule holds its parameters:
+
+    >>> schedule = make({'T0': 100, 'type': 'geometric',
+    ...                  'schedule': {'geometric': {'alpha': 0.5}}})
+    >>> schedule.temperature(1), schedule.temperature(3)
+    (50.0, 12.5)
+
+Schedules with feedback are told after every iteration or block of them
+how many moves would make the route longer, how many of those were
+accepted and whether the best route improved. They keep their own state
+which travels with the model state.
+"""
+
+import math
+import time
+
+
+class Schedule(object):
+    """Schedule -- temperature as a function of tick alone.
+    """
+    feedback = False
+
+    def __init__(self, t0):
+        self.t0 = float(t0)
+
+    def temperature(self, tick):
+        raise NotImplementedError
+
+    def observe(self, iterations, uphill, accepted, improved):
+        """(Schedule, int, int, int, bool) -> NoneType
+        """
+
+    def state(self):
+        return {}
+
+    def load_state(self, state):
+        pass
+
+
+class Fast(Schedule):
+    """T0 / tick
+    """
+    def temperature(self, tick):
+        return self.t0 / tick
+
+
+class Logarithmic(Schedule):
+    """T0 / log(1 + tick)
+    """
+    def temperature(self, tick):
+        return self.t0 / math.log(1 + tick)
+
+
+class Geometric(Schedule):
+    """T0 * alpha ** tick
+    """
+    def __init__(self, t0, alpha=0.9999):
+        super(Geometric, self).__init__(t0)
+        self.alpha = alpha
+
+    def temperature(self, tick):
+        return self.t0 * self.alpha ** tick
+
+
+class LundyMees(Schedule):
+    """T(k + 1) = T(k) / (1 + beta T(k)), that is T0 / (1 + beta T0 k).
+    """
+    def __init__(self, t0, beta=1e-4):
+        super(LundyMees, self).__init__(t0)
+        self.beta = beta
+
+    def temperature(self, tick):
+        return self.t0 / (1. + self.beta * self.t0 * tick)
+
+
+class Adaptive(Schedule):
+    """Adaptive -- temperature steered to a target acceptance rate.
+
+    Only moves which make the route longer count: shorter ones are
+    accepted at any temperature. Every window of them the temperature
+    is raised or lowered by up to a factor of e depending on how far
+    their acceptance rate was from the target, and the target itself
+    decays towards final_acceptance.
+    After reheat_after iterations without a better route both the
+    temperature and the target are multiplied by reheat.
+
+    A new T0 scales the temperature reached so far with it. A schedule
+    which is not adapting keeps its temperature, e.g. for a replica
+    which follows another one:
+
+    >>> schedule = Adaptive(100, window=10)
+    >>> schedule.observe(10, 10, 0, False)
+    >>> schedule.temperature(10) > 100
+    True
+    >>> reached = schedule.temperature(10)
+    >>> schedule.t0 = 400
+    >>> schedule.temperature(10) == 4 * reached
+    True
+    >>> schedule.adapting = False
+    >>> schedule.observe(10, 10, 0, False)
+    >>> schedule.temperature(10) == 4 * reached
+    True
+    """
+    feedback = True
+
+    def __init__(self, t0, target_acceptance=0.3, final_acceptance=0.001,
+                 acceptance_decay=0.99, window=1000, reheat_after=None,
+                 reheat=10.):
+        super(Adaptive, self).__init__(t0)
+        self.adapting = True
+        self.target_acceptance = target_acceptance
+        self.final_acceptance = final_acceptance
+        self.acceptance_decay = acceptance_decay
+        self.window = window
+        self.reheat_after = reheat_after
+        self.reheat = reheat
+        self.current = self.t0
+        self.target = target_acceptance
+        self.reheats = 0
+        self._proposed = 0
+        self._accepted = 0
+        self._stale = 0
+
+    @property
+    def t0(self):
+        return self._t0
+
+    @t0.setter
+    def t0(self, t0):
+        t0 = float(t0)
+        if hasattr(self, 'current'):
+            self.current *= t0 / self._t0
+        self._t0 = t0
+
+    def temperature(self, tick):
+        return self.current
+
+    def observe(self, iterations, uphill, accepted, improved):
+        if not self.adapting:
+            return
+        self._proposed += uphill
+        self._accepted += accepted
+        self._stale = 0 if improved else self._stale + iterations
+        if self._proposed >= self.window:
+            rate = float(self._accepted) / self._proposed
+            error = (self.target - rate) / self.target
+            self.current *= math.exp(max(-1., min(error, 1.)))
+            self.target = max(self.target * self.acceptance_decay,
+                              self.final_acceptance)
+            self._proposed = self._accepted = 0
+        if self.reheat_after is not None and self._stale >= self.reheat_after:
+            self.current *= self.reheat
+            self.target = min(self.target * self.reheat,
+                              self.target_acceptance)
+            self.reheats += 1
+            self._stale = 0
+
+    def state(self):
+        return {
+            't0': self.t0,
+            'adapting': self.adapting,
+            'current': self.current,
+            'target': self.target,
+            'reheats': self.reheats,
+            'proposed': self._proposed,
+            'accepted': self._accepted,
+            'stale': self._stale,
+        }
+
+    def load_state(self, state):
+        # T0 of the state, the temperature reached goes with it as is.
+        self._t0 = float(state.get('t0', self._t0))
+        self.adapting = state.get('adapting', True)
+        self.current = state['current']
+        self.target = state['target']
+        self.reheats = state['reheats']
+        self._proposed = state['proposed']
+        self._accepted = state['accepted']
+        self._stale = state['stale']
+
+
+SCHEDULES = {
+    'fast': Fast,
+    'log': Logarithmic,
+    'geometric': Geometric,
+    'lundy_mees': LundyMees,
+    'adaptive': Adaptive,
+}
+
+
+def make(config):
+    """(dict) -> Schedule
+
+    Schedule named by type of the model config.
+    """
+    name = config['type']
+    if name not in SCHEDULES:
+        raise ValueError('Unknown schedule: {0}'.format(name))
+    parameters = (config.get('schedule') or {}).get(name) or {}
+    return SCHEDULES[name](config['T0'], **parameters)
+
+
+class StopRule(object):
+    """StopRule -- when a run is over.
+
+    Any of the limits may be None: iterations of this run, iterations
+    without a better route (patience), temperature floor and wall clock
+    seconds of this run.
+    """
+    def __init__(self, iterations=None, patience=None, min_temperature=None,
+                 time_limit=None):
+        self.iterations = iterations
+        self.patience = patience
+        self.min_temperature = min_temperature
+        self.time_limit = time_limit
+        self._first = 0
+        self._start = time.time()
+
+    @classmethod
+    def from_config(cls, config, **overrides):
+        """(dict, ...) -> StopRule
+
+        Limits of the stop section of the config, overrides which are
+        not None take precedence.
+        """
+        limits = dict(config.get('stop') or {})
+        limits.update((key, value) for key, value in overrides.items()
+                      if value is not None)
+        return cls(**limits)
+
+    def __bool__(self):
+        return any(limit is not None for limit in (
+            self.iterations, self.patience, self.min_temperature,
+            self.time_limit))
+
+    def start(self, model):
+        """(StopRule, SalesmanRoute) -> NoneType
+        """
+        self._first = model.iteration
+        self._start = time.time()
+
+    def steps(self, model, most):
+        """(StopRule, SalesmanRoute, int) -> int
+
+        How many iterations to run before asking reason() again.
+        """
+        if self.iterations is not None:
+            most = min(most, self.iterations - (model.iteration - self._first))
+        if self.patience is not None:
+            most = min(most, self.patience -
+                       (model.iteration - model.last_improvement))
+        return max(most, 0)
+
+    def reason(self, model):
+        """(StopRule, SalesmanRoute) -> str
+
+        Name of the limit reached, None while the run goes on.
+        """
+        if (self.iterations is not None and
+                model.iteration - self._first >= self.iterations):
+            return 'iterations'
+        if (self.patience is not None and
+                model.iteration - model.last_improvement >= self.patience):
+            return 'patience'
+        if (self.min_temperature is not None and
+                model.temperature <= self.min_temperature):
+            return 'min_temperature'
+        if (self.time_limit is not None and
+                time.time() - self._start >= self.time_limit):
+            return 'time_limit'
+        return None
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""Loader of TSPLIB and CSV instances.
+
+TSPLIB .tsp files with EUC_2D, ATT or GEO edge weights and plain CSV
+files of "x,y" or "id,x,y" rows (a header line is skipped) are read
+line by line straight into a preallocated array, gzipped files too.
+The annealer works on planar towns: coordinates as they are for EUC_2D
+and ATT, an equirectangular projection for GEO. Tour lengths and the
+optimality gap are measured with the instance's own metric against
+the optimal tour from <name>.opt.tour next to the instance, if there
+is one:
+
+    >>> instance = load('berlin52.tsp')               # doctest: +SKIP
+    >>> instance.gap(model.best_order)                # doctest: +SKIP
+"""
+
+import os
+import gzip
+
+import numpy
+
+
+METRICS = ('EUC_2D', 'ATT', 'GEO')
+
+# Constants of the TSPLIB definition of GEO distances.
+GEO_PI = 3.141592
+GEO_RADIUS = 6378.388
+
+
+class Instance(object):
+    """Instance -- coordinates of towns and the way to measure tours.
+    """
+    def __init__(self, name, coordinates, metric='EUC_2D',
+                 optimal_tour=None):
+        if metric not in METRICS:
+            raise ValueError('Unsupported edge weight type: {0}'.format(
+                metric))
+        self.name = name
+        self.coordinates = coordinates
+        self.metric = metric
+        self.optimal_tour = optimal_tour
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    @property
+    def towns(self):
+        """Planar coordinates of towns for the annealer.
+        """
+        if self.metric != 'GEO':
+            return self.coordinates
+        latitude, longitude = _geo_radians(self.coordinates).T
+        return GEO_RADIUS * numpy.stack(
+            (longitude * numpy.cos(latitude.mean()), -latitude), axis=1)
+
+    def tour_length(self, order):
+        """(Instance, (N,) numpy.array) -> int
+
+        Length of the closed tour in the instance metric.
+        """
+        points = self.coordinates[numpy.asarray(order)]
+        following = numpy.roll(points, -1, axis=0)
+        if self.metric == 'EUC_2D':
+            weights = numpy.floor(
+                numpy.hypot(*(points - following).T) + 0.5)
+        elif self.metric == 'ATT':
+            distance = numpy.sqrt(
+                ((points - following) ** 2).sum(axis=1) / 10.)
+            weights = numpy.floor(distance + 0.5)
+            weights[weights < distance] += 1
+        else:
+            a, b = _geo_radians(points), _geo_radians(following)
+            q1 = numpy.cos(a[:, 1] - b[:, 1])
+            q2 = numpy.cos(a[:, 0] - b[:, 0])
+            q3 = numpy.cos(a[:, 0] + b[:, 0])
+            weights = numpy.floor(GEO_RADIUS * numpy.arccos(numpy.clip(
+                0.5 * ((1. + q1) * q2 - (1. - q1) * q3), -1., 1.)) + 1.)
+        return int(weights.sum())
+
+    @property
+    def optimal_length(self):
+        if self.optimal_tour is None:
+            return None
+        return self.tour_length(self.optimal_tour)
+
+    def report(self, order):
+        """(Instance, (N,) numpy.array) -> dict
+
+        The tour measured in the instance metric, for run results.
+        """
+        return {
+            'name': self.name,
+            'metric': self.metric,
+            'tour_length': self.tour_length(order),
+            'optimal_length': self.optimal_length,
+            'gap': self.gap(order),
+        }
+
+    def gap(self, order):
+        """(Instance, (N,) numpy.array) -> float
+
+        Relative excess of the tour over the optimal one, None when the
+        optimum is unknown.
+        """
+        optimum = self.optimal_length
+        if optimum is None:
+            return None
+        return float(self.tour_length(order) - optimum) / optimum
+
+
+def _geo_radians(coordinates):
+    """DDD.MM latitude and longitude to radians, as TSPLIB does.
+    """
+    degrees = numpy.trunc(coordinates)
+    minutes = coordinates - degrees
+    return GEO_PI * (degrees + 5. * minutes / 3.) / 180.
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path, 'rt')
+
+
+def _read_header(lines):
+    """Keywords of the specification part up to the first section.
+    """
+    header = {}
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if ':' in line:
+            key, value = line.split(':', 1)
+            header[key.strip().upper()] = value.strip()
+        else:
+            header['SECTION'] = line.upper()
+            break
+    return header
+
+
+def read_tsp(path):
+    """(str) -> (dict, (N, 2) numpy.array)
+
+    Keywords and node coordinates of a TSPLIB file.
+    """
+    with _open(path) as lines:
+        header = _read_header(lines)
+        if header.get('SECTION') != 'NODE_COORD_SECTION':
+            raise ValueError('{0}: no NODE_COORD_SECTION'.format(path))
+        size = int(header['DIMENSION'])
+        coordinates = numpy.empty((size, 2))
+        seen = 0
+        for line in lines:
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[0] == 'EOF' or not fields[0].lstrip('-').isdigit():
+                break
+            node = int(fields[0]) - 1
+            coordinates[node, 0] = float(fields[1])
+            coordinates[node, 1] = float(fields[2])
+            seen += 1
+    if seen != size:
+        raise ValueError('{0}: {1} nodes, DIMENSION is {2}'.format(
+            path, seen, size))
+    return header, coordinates
+
+
+def read_tour(path):
+    """(str) -> (N,) numpy.array
+
+    Zero based town indices of a TSPLIB .tour file.
+    """
+    with _open(path) as lines:
+        header = _read_header(lines)
+        if header.get('SECTION') != 'TOUR_SECTION':
+            raise ValueError('{0}: no TOUR_SECTION'.format(path))
+        tour = []
+        for line in lines:
+            for field in line.split():
+                if field == '-1' or field == 'EOF':
+                    return numpy.array(tour, dtype=int)
+                tour.append(int(field) - 1)
+    return numpy.array(tour, dtype=int)
+
+
+def read_csv(path, chunk=65536):
+    """(str, int) -> (N, 2) numpy.array
+
+    Coordinates from "x,y" or "id,x,y" rows, commas or white space
+    separated. The array grows by doubling, nothing else is kept.
+    """
+    coordinates = numpy.empty((chunk, 2))
+    count = 0
+    with _open(path) as lines:
+        for number, line in enumerate(lines):
+            fields = line.replace(',', ' ').split()
+            if not fields:
+                continue
+            try:
+                x, y = float(fields[-2]), float(fields[-1])
+            except (ValueError, IndexError):
+                if number == 0:
+                    continue
+                raise ValueError('{0}:{1}: bad row {2!r}'.format(
+                    path, number + 1, line))
+            if count == len(coordinates):
+                coordinates = numpy.resize(
+                    coordinates, (2 * len(coordinates), 2))
+            coordinates[count] = x, y
+            count += 1
+    return coordinates[:count].copy()
+
+
+def load(path):
+    """(str) -> Instance
+
+    A TSPLIB file, or CSV when the name ends with .csv(.gz).
+    """
+    name = os.path.basename(path)
+    for suffix in ('.gz', '.csv', '.tsp'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+
+    if path.endswith(('.csv', '.csv.gz')):
+        return Instance(name, read_csv(path))
+
+    header, coordinates = read_tsp(path)
+    optimal_tour = None
+    for suffix in ('.opt.tour', '.opt.tour.gz'):
+        tour_path = os.path.join(os.path.dirname(path), name + suffix)
+        if os.path.exists(tour_path):
+            optimal_tour = read_tour(tour_path)
+            break
+    return Instance(header.get('NAME', name), coordinates,
+                    header.get('EDGE_WEIGHT_TYPE', 'EUC_2D'), optimal_tour)
+
+
+def fit_to_window(points, size, margin=0.05):
+    """((N, 2) numpy.array, (int, int), float) -> (N, 2) numpy.array
+
+    Scale and shift points uniformly into the window leaving margin of
+    its size free on every side, for display.
+    """
+    size = numpy.array(size, dtype=float)
+    low = points.min(axis=0)
+    extent = numpy.maximum(points.max(axis=0) - low, 1e-12)
+    inner = size * (1. - 2. * margin)
+    scale = (inner / extent).min()
+    offset = size * margin + (inner - extent * scale) / 2.
+    return (points - low) * scale + offset